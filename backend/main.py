@@ -11,6 +11,7 @@ from typing import Optional
 import csv
 import io
 import json
+import hashlib
 from pydantic import BaseModel
 from models import LogInput
 from models import Log, Complaint, Role, Override, Synonym, Priority
@@ -22,6 +23,16 @@ import logging
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+try:
+    from pymorphy2 import MorphAnalyzer
+    morph = MorphAnalyzer()
+except ImportError:
+    print("⚠️ pymorphy2 не установлен — индекс синонимов без лемм")
+    morph = None
+
+# Скомпилированный индекс синонимов; сбрасывается при добавлении синонима
+synonym_index_cache = None
+
 app = FastAPI()
 
 app.add_middleware(
@@ -461,8 +472,38 @@ async def get_stats():
     }
 
 
+def build_synonym_index(pairs):
+    """Индекс синонимов для бота.
+
+    groups — ключевое слово -> синонимы; terms — слово или фраза (в нижнем
+    регистре) -> группы, где оно ключ или синоним; lemmas — то же по
+    начальной форме однословных терминов (пусто без pymorphy2); version —
+    хэш содержимого. Единственная полная реализация: бот без этого эндпоинта
+    строит только groups и terms.
+    """
+    pairs = sorted({(keyword, synonym) for keyword, synonym in pairs})
+    groups = {}
+    for keyword, synonym in pairs:
+        groups.setdefault(keyword, []).append(synonym)
+
+    terms, lemmas = {}, {}
+    for keyword, synonyms in groups.items():
+        for term in [keyword, *synonyms]:
+            term = term.lower().strip()
+            if keyword not in terms.setdefault(term, []):
+                terms[term].append(keyword)
+            if morph is not None and " " not in term:
+                lemma = morph.parse(term)[0].normal_form
+                if keyword not in lemmas.setdefault(lemma, []):
+                    lemmas[lemma].append(keyword)
+
+    version = hashlib.sha1(json.dumps(pairs, ensure_ascii=False).encode("utf-8")).hexdigest()[:12]
+    return {"version": version, "groups": groups, "terms": terms, "lemmas": lemmas}
+
+
 @app.post("/synonyms")
 async def add_synonym(keyword: str, synonym: str):
+    global synonym_index_cache
     logger.info(f"🔄 Попытка добавить синоним: {keyword} → {synonym}")
 
     # Начинаем транзакцию явно
@@ -477,6 +518,7 @@ async def add_synonym(keyword: str, synonym: str):
 
         new_synonym = await Synonym.create(keyword=keyword, synonym=synonym)
         await conn.execute_query("COMMIT;")
+        synonym_index_cache = None
         logger.info(f"✅ Синоним добавлен в базу: {new_synonym.keyword} → {new_synonym.synonym}")
         return new_synonym
     except Exception as e:
@@ -494,6 +536,17 @@ async def get_synonyms():
         logger.debug(f"  - {s.keyword} → {s.synonym}")
     return await Synonym.all()
 
+@app.get("/synonyms/index")
+async def get_synonym_index():
+    """Скомпилированный индекс синонимов (строится при первом запросе после изменений)"""
+    global synonym_index_cache
+    if synonym_index_cache is None:
+        pairs = await Synonym.all().values_list("keyword", "synonym")
+        synonym_index_cache = build_synonym_index(pairs)
+        logger.info(f"✅ Индекс синонимов собран: {len(synonym_index_cache['groups'])} групп, "
+                    f"версия {synonym_index_cache['version']}")
+    return synonym_index_cache
+
 @app.post("/priorities")
 async def add_priority(keyword: str, document_name: str):
     existing = await Priority.filter(keyword=keyword).first()
@@ -1,11 +1,86 @@
 import os
+import re
+import json
+import random
+import argparse
+import hashlib
+import zipfile
+import unicodedata
+from array import array
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from itertools import groupby, islice
+from datetime import datetime
+import tiktoken
 from langchain_community.document_loaders import PyPDFLoader, Docx2txtLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.docstore.document import Document
+from pymorphy2 import MorphAnalyzer
 import sqlite3
 
 
 DOCS_FOLDER = "docs"
+DB_PATH = os.environ.get("BOT_DB_PATH", "bot_data.db")
+# По умолчанию парсим последовательно: sync_documents вызывает и бот, где пул процессов
+# форкал бы загруженные модели. Параллельный режим включается из CLI: --workers N
+PARSE_WORKERS = 1
+# Размер пачки при записи чанков в SQLite
+WRITE_BATCH_SIZE = 500
+
+# Версия логики разбиения: при любом изменении сплиттера или фильтра
+# увеличиваем её, и все документы будут перепарсены при следующей синхронизации
+CHUNKER_VERSION = 6
+SUPPORTED_EXTENSIONS = (".pdf", ".docx")
+# Список приоритетных документов (в нижнем регистре)
+PRIORITY_FILES = {"rules.docx"}
+
+# === ВЕКТОРНЫЙ ИНДЕКС ===
+# Строит vectorize_chunks.py, читает бот; константы здесь, чтобы боту не импортировать скрипт векторизации
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+FAISS_INDEX_PATH = "faiss_index"
+# id чанков и хэши их текста в порядке строк индекса; пишется последним — по нему
+# бот видит новый индекс и отбрасывает строки, чей чанк с тех пор изменился
+CHUNK_IDS_FILE = "chunk_ids.json"
+
+# === РАЗБИЕНИЕ ПО ТОКЕНАМ ===
+# Размеры чанков считаются в токенах той же модели, что отвечает на вопросы,
+# поэтому чанк сразу является готовым блоком для GPT и не переразбивается в боте
+TOKEN_MODEL = "gpt-3.5-turbo"
+CHUNK_TOKENS = 120  # ~300 символов русского текста
+CHUNK_OVERLAP_TOKENS = 40
+PRIORITY_CHUNK_TOKENS = 1200  # крупные блоки для приоритетных документов
+PRIORITY_CHUNK_OVERLAP_TOKENS = 200
+encoding = tiktoken.encoding_for_model(TOKEN_MODEL)
+
+# === ПРИЗНАКИ ЧАНКОВ ===
+# Роли, для которых в инструкциях есть разделы с заголовком **...роль...**
+ROLE_HEADINGS = ("администратор", "менеджер", "руководитель")
+ROLE_HEADING_PATTERNS = {
+    role: re.compile(fr'\*\*\s*{role}.*?\*\*|\*\*.*?{role}.*?\*\*', re.IGNORECASE)
+    for role in ROLE_HEADINGS
+}
+HEADING_PATTERN = re.compile(r'\*\*([^*]+)\*\*')
+STEPS_PATTERN = re.compile(r'\d+\.\s|\d+\)\s|•\s')  # нумерованные шаги и пункты
+
+# === ПРОФИЛИ ДОКУМЕНТОВ (грубый отбор документов перед поиском по чанкам) ===
+PROFILE_TOP_LEMMAS = 50
+PROFILE_MAX_HEADINGS = 30
+FUNCTIONAL_POS = {"PREP", "CONJ", "PRCL", "INTJ", "NPRO"}  # служебные части речи
+morph = MorphAnalyzer()
+
+# === ПОИСК ПОЧТИ-ДУБЛИКАТОВ (MinHash + LSH) ===
+SHINGLE_SIZE = 3  # шинглы из 3 слов
+MINHASH_PERMUTATIONS = 64
+LSH_BANDS = 16  # 16 полос по 4 значения: кандидаты с похожестью от ~0.5
+DUPLICATE_THRESHOLD = 0.8  # оценка Жаккара, начиная с которой чанки считаем дубликатами
+_MERSENNE_PRIME = (1 << 61) - 1
+_rng = random.Random(42)  # фиксированное зерно — подписи стабильны между запусками
+MINHASH_PARAMS = [
+    (_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME))
+    for _ in range(MINHASH_PERMUTATIONS)
+]
 
 FILTER_PHRASES = [
     "Визировать документы", "Лист ознакомления", "Ф.И.О.",
@@ -22,112 +97,940 @@ def is_garbage(text):
     return False
 
 
-def load_documents(folder):
-    documents = []
-    for filename in os.listdir(folder):
-        filepath = os.path.join(folder, filename)
-        try:
-            if filename.endswith(".pdf"):
-                loader = PyPDFLoader(filepath)
-            elif filename.endswith(".docx"):
-                # Проверка файла перед загрузкой
-                import zipfile
-                if not zipfile.is_zipfile(filepath):
-                    print(f"❌ ОШИБКА: Файл {filename} поврежден или не является DOCX файлом!")
-                    continue
-                loader = Docx2txtLoader(filepath)
-            else:
-                continue
+def _open_loader(folder, filename):
+    """Возвращает (loader, error) для файла"""
+    filepath = os.path.join(folder, filename)
+    if filename.endswith(".pdf"):
+        return PyPDFLoader(filepath), None
+    if filename.endswith(".docx"):
+        # Проверка файла перед загрузкой
+        if not zipfile.is_zipfile(filepath):
+            return None, f"❌ ОШИБКА: Файл {filename} поврежден или не является DOCX файлом!"
+        return Docx2txtLoader(filepath), None
+    return None, None
+
+
+def _load_file(folder, filename):
+    """Загружает один файл. Выполняется в процессе пула, поэтому ошибку
+    возвращаем вторым элементом, а печатает её родительский процесс."""
+    try:
+        loader, error = _open_loader(folder, filename)
+        if loader is None:
+            return [], error
 
-            #print(f"📄 Обработка файла: {filename}")
-            loaded_docs = loader.load()
+        #print(f"📄 Обработка файла: {filename}")
+        loaded_docs = loader.load()
+        for doc in loaded_docs:
+            doc.metadata["source"] = filename
+        return loaded_docs, None
 
-            for doc in loaded_docs:
-                doc.metadata["source"] = filename
-                documents.append(doc)
+    except Exception as e:
+        return [], f"❌ ОШИБКА при загрузке файла {filename}: {str(e)}"
 
-            #print(f"✅ Файл {filename} успешно загружен")
 
+def _lazy_pages(loader, filename):
+    for doc in loader.lazy_load():
+        doc.metadata["source"] = filename
+        yield doc
+
+
+def _iter_lazy_files(folder, filenames):
+    for filename in filenames:
+        try:
+            loader, error = _open_loader(folder, filename)
         except Exception as e:
-            print(f"❌ ОШИБКА при загрузке файла {filename}: {str(e)}")
+            loader, error = None, f"❌ ОШИБКА при загрузке файла {filename}: {str(e)}"
+        if loader is None:
+            yield filename, [], error
+            continue
+        yield filename, _lazy_pages(loader, filename), None
+
+
+def iter_loaded_files(folder, filenames=None, workers=None):
+    """Генератор (filename, pages, error) строго в порядке filenames.
+
+    Без пула страницы читаются лениво (lazy_load), и в памяти одна страница.
+    В пуле процессов файл возвращается целиком, но одновременно в работе
+    не больше workers * 2 файлов. Если процесс пула упал, файл отдаётся
+    с ошибкой, а остальные читаются последовательно. Ошибки чтения ленивых
+    страниц всплывают при итерации по pages — их ловит вызывающий код.
+    """
+    if filenames is None:
+        filenames = sorted(os.listdir(folder))
+    filenames = [f for f in filenames if f.endswith(SUPPORTED_EXTENSIONS)]
+    if workers is None:
+        workers = PARSE_WORKERS
+
+    if workers <= 1 or len(filenames) <= 1:
+        yield from _iter_lazy_files(folder, filenames)
+        return
+
+    remaining = []
+    with ProcessPoolExecutor(max_workers=min(workers, len(filenames))) as pool:
+        queue = iter(filenames)
+        pending = deque(
+            (filename, pool.submit(_load_file, folder, filename))
+            for filename in islice(queue, workers * 2)
+        )
+        while pending:
+            # Забираем результаты в порядке списка, а не завершения
+            filename, future = pending.popleft()
+            try:
+                loaded_docs, error = future.result()
+            except BrokenProcessPool as e:
+                # Пул больше не примет задач — дочитываем остальное без него
+                remaining = [name for name, _ in pending] + list(queue)
+                yield filename, [], f"❌ ОШИБКА: пул процессов парсинга упал во время чтения {filename}: {e}"
+                break
+            next_name = next(queue, None)
+            if next_name is not None:
+                pending.append((next_name, pool.submit(_load_file, folder, next_name)))
+            yield filename, loaded_docs, error
+
+    if remaining:
+        print(f"⚠️ Пул процессов парсинга сломан, остальные {len(remaining)} файлов читаем последовательно")
+        yield from _iter_lazy_files(folder, remaining)
+
+
+def load_documents(folder, filenames=None, workers=None):
+    """Загружает файлы, при workers > 1 — параллельно в пуле процессов.
+
+    Порядок результата всегда совпадает с порядком filenames (по умолчанию —
+    отсортированный список папки), поэтому порядок чанков и их id стабильны.
+    """
+    documents = []
+    for filename, pages, error in iter_loaded_files(folder, filenames, workers):
+        if error:
             # Продолжаем с другими файлами
+            print(error)
             continue
+        try:
+            documents.extend(list(pages))
+        except Exception as e:
+            print(f"❌ ОШИБКА при загрузке файла {filename}: {str(e)}")
 
     return documents
 
-def split_and_filter_documents(documents):
-    # Список приоритетных документов (в нижнем регистре)
-    PRIORITY_FILES = {"rules.docx"}
+def num_tokens(text):
+    return len(encoding.encode(text))
 
-    final_chunks = []
-    for doc in documents:
-        filename = doc.metadata.get("source", "").lower()
-        is_priority = filename in PRIORITY_FILES
 
+_splitters = {}
+
+
+def get_splitter(is_priority):
+    """Токенный сплиттер (создаётся один раз на процесс)"""
+    if is_priority not in _splitters:
         if is_priority:
             # ДЛЯ ПРИОРИТЕТНЫХ ФАЙЛОВ - БОЛЕЕ КРУПНЫЕ ЧАНКИ
-            splitter = RecursiveCharacterTextSplitter(
-                chunk_size=3000,  # Увеличили в 2 раза
-                chunk_overlap=500,  # Больше перекрытие
+            _splitters[is_priority] = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+                model_name=TOKEN_MODEL,
+                chunk_size=PRIORITY_CHUNK_TOKENS,
+                chunk_overlap=PRIORITY_CHUNK_OVERLAP_TOKENS,
                 separators=["\n\n**", "\n\n", "\n", ".", " "]  # Разбиваем по заголовкам
             )
         else:
-            splitter = RecursiveCharacterTextSplitter(
-                chunk_size=300,
-                chunk_overlap=100,
+            _splitters[is_priority] = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+                model_name=TOKEN_MODEL,
+                chunk_size=CHUNK_TOKENS,
+                chunk_overlap=CHUNK_OVERLAP_TOKENS,
                 separators=["\n\n", "\n", ".", "!", "?", ",", " ", ""]
             )
+    return _splitters[is_priority]
 
-        chunks = splitter.split_documents([doc])
+
+def iter_chunks(documents):
+    """Генератор чанков: разбиение и фильтрация по одной странице за раз"""
+    for doc in documents:
+        filename = doc.metadata.get("source", "").lower()
+        is_priority = filename in PRIORITY_FILES
+
+        chunks = get_splitter(is_priority).split_documents([doc])
 
         if is_priority:
             # НЕ ФИЛЬТРУЕМ приоритетные документы
-            final_chunks.extend(chunks)
             print(f"🎯 ПРИОРИТЕТНЫЙ: {filename} разбит на {len(chunks)} чанков")
+            yield from chunks
         else:
-            filtered = [chunk for chunk in chunks if not is_garbage(chunk.page_content)]
-            final_chunks.extend(filtered)
+            yield from (chunk for chunk in chunks if not is_garbage(chunk.page_content))
 
-    return final_chunks
 
+def split_and_filter_documents(documents):
+    return list(iter_chunks(documents))
 
 
-def main():
-    documents = load_documents(DOCS_FOLDER)
-    chunks = split_and_filter_documents(documents)
-    print(f"✅ Загружено {len(documents)} документов.")
-    print(f"✅ После фильтрации: {len(chunks)} чанков.")
+def _batched(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
 
-    # Подготовим данные для записи в базу
-    results = [(chunk.metadata.get("source", "неизвестно"), chunk.page_content.strip()) for chunk in chunks]
 
-    # Запишем в базу
-    save_chunks_to_db(results)
+# === МАНИФЕСТ ИНДЕКСАЦИИ ===
+def file_hash(filepath):
+    """SHA-256 содержимого файла (читаем блоками, чтобы не держать файл в памяти)"""
+    h = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
 
-    return results
 
+def text_hash(text):
+    """SHA-256 текста чанка: ключ кэша эмбеддингов и сверки FAISS-индекса с корпусом"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
 
-def parse_and_return_chunks():
-    documents = load_documents(DOCS_FOLDER)
-    chunks = split_and_filter_documents(documents)
-    results = [(chunk.metadata.get("source", "неизвестно"), chunk.page_content.strip()) for chunk in chunks]
-    return results
 
-def save_chunks_to_db(chunks):
-    conn = sqlite3.connect("bot_data.db")
+CHUNKS_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS {table} (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    document_name TEXT,
+    chunk TEXT,
+    token_count INTEGER,
+    roles TEXT,
+    has_steps INTEGER,
+    section_title TEXT,
+    text_norm TEXT,
+    lemmas TEXT,
+    position INTEGER,
+    prev_id INTEGER,
+    next_id INTEGER,
+    minhash BLOB,
+    duplicate_of INTEGER,
+    sources TEXT
+)
+"""
+CHUNK_INSERT_SQL = (
+    "INSERT INTO {table} "
+    "(document_name, chunk, token_count, roles, has_steps, section_title, text_norm, lemmas, position, minhash) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+)
+SHADOW_TABLE = "chunks_shadow"
+# Полнотекстовый индекс по леммам чанков (BM25); содержимое берётся из chunks
+FTS_TABLE_SQL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts "
+    "USING fts5(lemmas, content='chunks', content_rowid='id')"
+)
+FTS_TOP_K = 50
+
+
+def connect_db(db_path=DB_PATH):
+    """Соединение в режиме WAL: читатели не блокируются писателем и
+    всегда видят последнее закоммиченное состояние таблиц"""
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def init_db(conn):
     cur = conn.cursor()
+    cur.execute(CHUNKS_TABLE_SQL.format(table="chunks"))
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_chunks_document_name ON chunks (document_name)")
+    try:
+        fts_existed = _fts_enabled(conn)
+        cur.execute(FTS_TABLE_SQL)
+        if not fts_existed:
+            # Базы до появления FTS: индексируем уже записанные чанки один раз,
+            # дальше индекс обновляется по документам
+            rebuild_fts(conn)
+    except sqlite3.OperationalError as e:
+        # SQLite без FTS5 — бот будет искать перебором, как раньше
+        print(f"⚠️ FTS5 недоступен: {e}")
     cur.execute("""
-    CREATE TABLE IF NOT EXISTS chunks (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        document_name TEXT,
-        chunk TEXT
+    CREATE TABLE IF NOT EXISTS document_profiles (
+        document_name TEXT PRIMARY KEY,
+        title TEXT,
+        headings TEXT,
+        top_lemmas TEXT,
+        heading_lemmas TEXT,
+        chunk_count INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    if "centroid" in _table_columns(conn, "document_profiles"):
+        # Колонка из старых баз: центроиды больше не считаются
+        try:
+            cur.execute("ALTER TABLE document_profiles DROP COLUMN centroid")
+        except sqlite3.OperationalError:
+            pass
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS corpus_state (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        version INTEGER NOT NULL
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS ingest_manifest (
+        path TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime REAL NOT NULL,
+        content_hash TEXT NOT NULL,
+        chunker_version INTEGER NOT NULL,
+        chunk_count INTEGER NOT NULL DEFAULT 0,
+        updated_at TEXT
     )
     """)
-    cur.execute("DELETE FROM chunks")  # очищаем старое
-    for docname, text in chunks:
-        cur.execute("INSERT INTO chunks (document_name, chunk) VALUES (?, ?)", (docname, text))
     conn.commit()
-    conn.close()
+
+
+def bump_corpus_version(conn):
+    """Увеличивает версию корпуса — по ней бот видит, что пора обновить снимок.
+
+    Вызывается в той же транзакции, что меняет chunks. Коммит — на вызывающем.
+    """
+    conn.execute(
+        "INSERT INTO corpus_state (id, version) VALUES (1, 1) "
+        "ON CONFLICT(id) DO UPDATE SET version = version + 1"
+    )
+
+
+def _corpus_version(conn):
+    row = conn.execute("SELECT version FROM corpus_state WHERE id = 1").fetchone()
+    return row[0] if row else 0
+
+
+def read_corpus_version(db_path=DB_PATH):
+    """Текущая версия корпуса в базе (0 — база ещё не индексировалась)"""
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        return _corpus_version(conn)
+    except sqlite3.OperationalError:
+        return 0
+    finally:
+        conn.close()
+
+
+def normalize_text(text):
+    """Нижний регистр, NFKC и схлопнутые пробелы — для поиска подстрок"""
+    return " ".join(unicodedata.normalize("NFKC", text).lower().split())
+
+
+def extract_features(text, current_section=None):
+    """Признаки чанка, которые бот раньше считал регулярками на каждый вопрос.
+
+    Возвращает (roles, has_steps, section_title, last_heading): роли из
+    заголовков, наличие нумерованных шагов, раздел, к которому относится
+    начало чанка, и последний заголовок внутри чанка (раздел для следующих).
+    """
+    roles = [role for role, pattern in ROLE_HEADING_PATTERNS.items() if pattern.search(text)]
+    has_steps = bool(STEPS_PATTERN.search(text))
+    headings = [h.strip() for h in HEADING_PATTERN.findall(text) if h.strip()]
+    section_title = current_section or (headings[0] if headings else None)
+    last_heading = headings[-1] if headings else current_section
+    return roles, has_steps, section_title, last_heading
+
+
+def _chunk_rows(filename, chunks, section=None):
+    """Строки для CHUNK_INSERT_SQL из чанков одного файла (в порядке документа)"""
+    for position, chunk in enumerate(chunks):
+        text = chunk.page_content.strip()
+        roles, has_steps, section_title, section = extract_features(text, section)
+        yield (
+            filename, text, num_tokens(text), ",".join(roles), int(has_steps),
+            section_title, normalize_text(text), " ".join(lemmatize(text)), position,
+            minhash_signature(text)
+        )
+
+
+def link_neighbours(conn, table="chunks", filename=None):
+    """Проставляет prev_id/next_id соседних чанков внутри документа.
+
+    Без filename — для всех документов таблицы. Коммит — на вызывающем.
+    """
+    query = f"SELECT id, document_name FROM {table}"
+    params = ()
+    if filename is not None:
+        query += " WHERE document_name = ?"
+        params = (filename,)
+
+    links = []
+    previous_id, previous_doc = None, None
+    for chunk_id, docname in conn.execute(query + " ORDER BY document_name, position, id", params):
+        if docname != previous_doc:
+            previous_id = None
+        links.append([previous_id, None, chunk_id])
+        if previous_id is not None:
+            links[-2][1] = chunk_id
+        previous_id, previous_doc = chunk_id, docname
+
+    conn.executemany(f"UPDATE {table} SET prev_id = ?, next_id = ? WHERE id = ?", links)
+
+
+@lru_cache(maxsize=100_000)
+def lemmatize_word(word):
+    """Начальная форма слова; None для коротких слов, чисел и служебных частей речи"""
+    if len(word) < 3 or word.isdigit():
+        return None
+    parsed = morph.parse(word)[0]
+    if parsed.tag.POS in FUNCTIONAL_POS:
+        return None
+    return parsed.normal_form
+
+
+def lemmatize(text):
+    return [lemma for lemma in map(lemmatize_word, re.findall(r"\w+", text.lower())) if lemma]
+
+
+def refresh_document_profiles(conn, filenames=None):
+    """Пересчитывает профили документов по таблице chunks.
+
+    Профиль — название, заголовки разделов, леммы названия и заголовков и
+    PROFILE_TOP_LEMMAS самых частых лемм с долями. Без filenames — все документы.
+    Коммит — на вызывающем.
+    """
+    if filenames is None:
+        conn.execute("DELETE FROM document_profiles")
+        filenames = [row[0] for row in conn.execute("SELECT DISTINCT document_name FROM chunks")]
+
+    for filename in filenames:
+        counts = Counter()
+        headings = []
+        chunk_count = 0
+        for (text,) in conn.execute(
+            "SELECT chunk FROM chunks WHERE document_name = ? ORDER BY position, id", (filename,)
+        ):
+            chunk_count += 1
+            counts.update(lemmatize(text))
+            for heading in HEADING_PATTERN.findall(text):
+                heading = heading.strip()
+                if heading and heading not in headings and len(headings) < PROFILE_MAX_HEADINGS:
+                    headings.append(heading)
+
+        if not chunk_count:
+            conn.execute("DELETE FROM document_profiles WHERE document_name = ?", (filename,))
+            continue
+
+        title = os.path.splitext(filename)[0]
+        total = sum(counts.values()) or 1
+        top_lemmas = {lemma: round(n / total, 5) for lemma, n in counts.most_common(PROFILE_TOP_LEMMAS)}
+        heading_lemmas = sorted(set(lemmatize(" ".join([title] + headings))))
+        conn.execute(
+            "INSERT OR REPLACE INTO document_profiles "
+            "(document_name, title, headings, top_lemmas, heading_lemmas, chunk_count) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (filename, title, json.dumps(headings, ensure_ascii=False),
+             json.dumps(top_lemmas, ensure_ascii=False), " ".join(heading_lemmas), chunk_count)
+        )
+
+
+def _fts_enabled(conn):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'chunks_fts'").fetchone() is not None
+
+
+def rebuild_fts(conn):
+    """Перестраивает FTS-индекс по текущей таблице chunks. Коммит — на вызывающем"""
+    if _fts_enabled(conn):
+        conn.execute("INSERT INTO chunks_fts(chunks_fts) VALUES ('rebuild')")
+
+
+def fts_unindex_document(conn, filename):
+    """Убирает чанки документа из FTS; вызывать до удаления строк из chunks"""
+    if _fts_enabled(conn):
+        conn.execute(
+            "INSERT INTO chunks_fts(chunks_fts, rowid, lemmas) "
+            "SELECT 'delete', id, lemmas FROM chunks WHERE document_name = ?",
+            (filename,)
+        )
+
+
+def fts_index_document(conn, filename):
+    """Добавляет в FTS только что записанные чанки документа"""
+    if _fts_enabled(conn):
+        conn.execute(
+            "INSERT INTO chunks_fts(rowid, lemmas) SELECT id, lemmas FROM chunks WHERE document_name = ?",
+            (filename,)
+        )
+
+
+def _shingles(text):
+    words = re.findall(r"\w+", text.lower())
+    if len(words) <= SHINGLE_SIZE:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+def minhash_signature(text):
+    """MinHash-подпись текста в виде BLOB (uint64 × MINHASH_PERMUTATIONS)"""
+    hashes = [
+        int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "little")
+        for s in _shingles(text)
+    ]
+    if not hashes:
+        return None
+    signature = array("Q", (min((a * h + b) % _MERSENNE_PRIME for h in hashes) for a, b in MINHASH_PARAMS))
+    return signature.tobytes()
+
+
+def _similarity(sig_a, sig_b):
+    return sum(x == y for x, y in zip(sig_a, sig_b)) / len(sig_a)
+
+
+def dedup_chunks(conn, table="chunks"):
+    """Схлопывает почти-дубликаты.
+
+    Выживает первый чанк группы (по id); у остальных duplicate_of указывает
+    на выжившего, а в sources выжившего перечислены все файлы группы.
+    Приоритетные документы не схлопываются. Подписи читаются все, но
+    записываются только строки, у которых что-то изменилось. Коммит — на вызывающем.
+    """
+    rows_per_band = MINHASH_PERMUTATIONS // LSH_BANDS
+    band_bytes = rows_per_band * 8
+    buckets = {}
+    signatures = {}
+    sources = {}
+    duplicate_of = {}
+    stored = {}
+
+    for chunk_id, docname, blob, old_duplicate_of, old_sources in conn.execute(
+        f"SELECT id, document_name, minhash, duplicate_of, sources FROM {table} ORDER BY id"
+    ):
+        stored[chunk_id] = (old_duplicate_of, old_sources)
+        if blob is None or (docname or "").lower() in PRIORITY_FILES:
+            sources[chunk_id] = [docname]
+            continue
+
+        signature = array("Q")
+        signature.frombytes(blob)
+        band_keys = [(band, blob[band * band_bytes:(band + 1) * band_bytes]) for band in range(LSH_BANDS)]
+
+        match = None
+        checked = set()
+        for key in band_keys:
+            for candidate in buckets.get(key, ()):
+                if candidate in checked:
+                    continue
+                checked.add(candidate)
+                if _similarity(signature, signatures[candidate]) >= DUPLICATE_THRESHOLD:
+                    match = candidate
+                    break
+            if match is not None:
+                break
+
+        if match is not None:
+            duplicate_of[chunk_id] = match
+            if docname not in sources[match]:
+                sources[match].append(docname)
+            continue
+
+        sources[chunk_id] = [docname]
+        signatures[chunk_id] = signature
+        for key in band_keys:
+            buckets.setdefault(key, []).append(chunk_id)
+
+    survivors = (
+        (json.dumps(names, ensure_ascii=False), chunk_id) for chunk_id, names in sources.items()
+    )
+    conn.executemany(
+        f"UPDATE {table} SET duplicate_of = NULL, sources = ? WHERE id = ?",
+        [(names, chunk_id) for names, chunk_id in survivors if stored[chunk_id] != (None, names)]
+    )
+    conn.executemany(
+        f"UPDATE {table} SET duplicate_of = ?, sources = NULL WHERE id = ?",
+        [
+            (survivor, chunk_id) for chunk_id, survivor in duplicate_of.items()
+            if stored[chunk_id] != (survivor, None)
+        ]
+    )
+    return len(duplicate_of)
+
+
+def _insert_chunks(conn, table, rows):
+    count = 0
+    for batch in _batched(rows, WRITE_BATCH_SIZE):
+        conn.executemany(CHUNK_INSERT_SQL.format(table=table), batch)
+        count += len(batch)
+    return count
+
+
+def scan_changes(conn, folder, force=False):
+    """Сравнивает папку с манифестом.
+
+    Возвращает (current, changed, deleted, fingerprints): все файлы папки,
+    новые/изменённые файлы, удалённые файлы и
+    {filename: (size, mtime, content_hash)} для изменённых.
+    Хэш считаем только если изменились размер или mtime (или force).
+    """
+    manifest = {
+        row[0]: row[1:]
+        for row in conn.execute(
+            "SELECT path, size, mtime, content_hash, chunker_version FROM ingest_manifest"
+        )
+    }
+
+    current = sorted(f for f in os.listdir(folder) if f.endswith(SUPPORTED_EXTENSIONS))
+    changed, fingerprints = [], {}
+
+    for filename in current:
+        stat = os.stat(os.path.join(folder, filename))
+        known = None if force else manifest.get(filename)
+        if known and known[0] == stat.st_size and known[1] == stat.st_mtime and known[3] == CHUNKER_VERSION:
+            continue
+
+        content_hash = file_hash(os.path.join(folder, filename))
+        if known and known[2] == content_hash and known[3] == CHUNKER_VERSION:
+            # Файл "потрогали", но содержимое то же — обновляем только mtime
+            conn.execute(
+                "UPDATE ingest_manifest SET size = ?, mtime = ? WHERE path = ?",
+                (stat.st_size, stat.st_mtime, filename)
+            )
+            continue
+
+        changed.append(filename)
+        fingerprints[filename] = (stat.st_size, stat.st_mtime, content_hash)
+    conn.commit()
+
+    # Удалёнными считаем всё, что есть в манифесте или в chunks, но пропало из папки
+    # (chunks учитываем для баз, созданных до появления манифеста)
+    known_names = set(manifest)
+    known_names.update(row[0] for row in conn.execute("SELECT DISTINCT document_name FROM chunks"))
+    deleted = sorted(known_names - set(current))
+
+    return current, changed, deleted, fingerprints
+
+
+def _manifest_row(filename, fingerprint, count):
+    size, mtime, content_hash = fingerprint
+    return filename, size, mtime, content_hash, CHUNKER_VERSION, count, datetime.now().isoformat()
+
+
+MANIFEST_UPSERT_SQL = """
+    INSERT OR REPLACE INTO ingest_manifest
+        (path, size, mtime, content_hash, chunker_version, chunk_count, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+def replace_document_chunks(conn, filename, chunks, fingerprint):
+    """Атомарно заменяет чанки одного файла и его запись в манифесте.
+
+    chunks может быть генератором — пишем пачками по WRITE_BATCH_SIZE.
+    FTS обновляется в той же транзакции. Возвращает количество записанных чанков.
+    """
+    with conn:
+        fts_unindex_document(conn, filename)
+        conn.execute("DELETE FROM chunks WHERE document_name = ?", (filename,))
+        count = _insert_chunks(conn, "chunks", _chunk_rows(filename, chunks))
+        link_neighbours(conn, "chunks", filename)
+        fts_index_document(conn, filename)
+        refresh_document_profiles(conn, [filename])
+        conn.execute(MANIFEST_UPSERT_SQL, _manifest_row(filename, fingerprint, count))
+        bump_corpus_version(conn)
+    return count
+
+
+def remove_document(conn, filename):
+    with conn:
+        fts_unindex_document(conn, filename)
+        conn.execute("DELETE FROM chunks WHERE document_name = ?", (filename,))
+        conn.execute("DELETE FROM document_profiles WHERE document_name = ?", (filename,))
+        conn.execute("DELETE FROM ingest_manifest WHERE path = ?", (filename,))
+        bump_corpus_version(conn)
+
+
+def _table_columns(conn, table):
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+
+def _create_shadow(conn):
+    """Пустая теневая таблица; счётчик id продолжает счётчик chunks.
+
+    id чанков не переиспользуются: на них ссылаются FAISS-индекс, FTS и бот,
+    и старый id не должен начать указывать на другой текст.
+    """
+    conn.execute(f"DROP TABLE IF EXISTS {SHADOW_TABLE}")
+    conn.execute(CHUNKS_TABLE_SQL.format(table=SHADOW_TABLE))
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'chunks'").fetchone()
+    if row is not None:
+        conn.execute("DELETE FROM sqlite_sequence WHERE name = ?", (SHADOW_TABLE,))
+        conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (SHADOW_TABLE, row[0]))
+    conn.commit()
+
+
+def _swap_in_shadow(conn, kept=(), manifest_rows=None):
+    """Одной транзакцией подменяет chunks теневой таблицей.
+
+    kept — файлы, которые не удалось перечитать: их старые чанки переносим
+    в теневую таблицу как есть. manifest_rows (если заданы) полностью
+    заменяют манифест, кроме записей kept.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if kept:
+            # Переносим только общие колонки — схема теневой таблицы могла измениться
+            old_columns = set(_table_columns(conn, "chunks"))
+            columns = ", ".join(
+                c for c in _table_columns(conn, SHADOW_TABLE) if c in old_columns and c != "id"
+            )
+            for filename in kept:
+                conn.execute(
+                    f"INSERT INTO {SHADOW_TABLE} ({columns}) "
+                    f"SELECT {columns} FROM chunks WHERE document_name = ? ORDER BY id",
+                    (filename,)
+                )
+
+        link_neighbours(conn, SHADOW_TABLE)
+        duplicates = dedup_chunks(conn, SHADOW_TABLE)
+        print(f"🧹 Почти-дубликатов схлопнуто: {duplicates}")
+
+        conn.execute("DROP TABLE IF EXISTS chunks_old")
+        conn.execute("ALTER TABLE chunks RENAME TO chunks_old")
+        conn.execute(f"ALTER TABLE {SHADOW_TABLE} RENAME TO chunks")
+        conn.execute("DROP TABLE chunks_old")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_chunks_document_name ON chunks (document_name)")
+        refresh_document_profiles(conn)
+        rebuild_fts(conn)
+
+        if manifest_rows is not None:
+            placeholders = ", ".join("?" for _ in kept)
+            conn.execute(f"DELETE FROM ingest_manifest WHERE path NOT IN ({placeholders})", tuple(kept))
+            conn.executemany(MANIFEST_UPSERT_SQL, manifest_rows)
+        bump_corpus_version(conn)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def rebuild_documents(conn, folder, filenames, fingerprints, workers=None):
+    """Полная пересборка: пишем всё в теневую таблицу, затем атомарно подменяем.
+
+    Пока идёт сборка, бот продолжает читать старую таблицу chunks целиком.
+    """
+    _create_shadow(conn)
+    manifest_rows, kept = [], []
+
+    for filename, pages, error in iter_loaded_files(folder, filenames, workers):
+        if error:
+            print(error)
+            kept.append(filename)
+            continue
+        try:
+            with conn:
+                count = _insert_chunks(conn, SHADOW_TABLE, _chunk_rows(filename, iter_chunks(pages)))
+        except Exception as e:
+            # Частично записанные строки файла откатились вместе с транзакцией
+            print(f"❌ ОШИБКА при загрузке файла {filename}: {str(e)}")
+            kept.append(filename)
+            continue
+        manifest_rows.append(_manifest_row(filename, fingerprints[filename], count))
+        print(f"🔄 Переиндексирован: {filename} ({count} чанков)")
+
+    _swap_in_shadow(conn, kept, manifest_rows)
+    return len(manifest_rows), len(kept)
+
+
+def sync_documents(folder=DOCS_FOLDER, db_path=DB_PATH, workers=None, full=False):
+    """Инкрементальная индексация: перепарсиваем только новые и изменённые файлы.
+
+    Если изменилось всё (full, первая индексация, новая CHUNKER_VERSION),
+    собираем корпус заново через теневую таблицу.
+    """
+    conn = connect_db(db_path)
+    try:
+        init_db(conn)
+        current, changed, deleted, fingerprints = scan_changes(conn, folder, force=full)
+
+        if changed and len(changed) == len(current):
+            updated, failed = rebuild_documents(conn, folder, changed, fingerprints, workers)
+            print(f"✅ Полная пересборка: обновлено {updated}, удалено {len(deleted)}")
+            return {"updated": updated, "deleted": len(deleted), "failed": failed}
+
+        for filename in deleted:
+            remove_document(conn, filename)
+            print(f"🗑 Удалён из индекса: {filename}")
+
+        updated = 0
+        for filename, pages, error in iter_loaded_files(folder, changed, workers):
+            if error:
+                # Файл не прочитался — оставляем старые чанки и не трогаем манифест,
+                # чтобы попробовать ещё раз при следующей синхронизации
+                print(error)
+                continue
+            try:
+                count = replace_document_chunks(conn, filename, iter_chunks(pages), fingerprints[filename])
+            except Exception as e:
+                # Транзакция файла откатилась — старые чанки на месте
+                print(f"❌ ОШИБКА при загрузке файла {filename}: {str(e)}")
+                continue
+            updated += 1
+            print(f"🔄 Переиндексирован: {filename} ({count} чанков)")
+
+        # Профили для документов, проиндексированных до появления профилей
+        missing = [row[0] for row in conn.execute(
+            "SELECT DISTINCT document_name FROM chunks "
+            "WHERE document_name NOT IN (SELECT document_name FROM document_profiles)"
+        )]
+        if missing:
+            with conn:
+                refresh_document_profiles(conn, missing)
+            print(f"🗂 Построено профилей документов: {len(missing)}")
+
+        if changed or deleted:
+            # FTS уже обновлён по документам; дубликаты пересчитываем по всем подписям
+            with conn:
+                duplicates = dedup_chunks(conn)
+                bump_corpus_version(conn)
+            print(f"🧹 Почти-дубликатов схлопнуто: {duplicates}")
+            print(f"✅ Синхронизация: обновлено {updated}, удалено {len(deleted)}")
+        return {"updated": updated, "deleted": len(deleted), "failed": len(changed) - updated}
+    finally:
+        conn.close()
+
+
+def _read_chunks(conn, include_duplicates=False):
+    rows = conn.execute(
+        "SELECT id, document_name, chunk, token_count, roles, has_steps, section_title, text_norm, "
+        "lemmas, position, prev_id, next_id, duplicate_of, sources FROM chunks "
+        + ("" if include_duplicates else "WHERE duplicate_of IS NULL ")
+        + "ORDER BY id"
+    )
+    chunks = []
+    for (chunk_id, docname, text, token_count, roles, has_steps, section_title, text_norm, lemmas,
+         position, prev_id, next_id, duplicate_of, sources) in rows:
+        docname = docname or "неизвестно"
+        chunks.append({
+            "id": chunk_id,
+            "document_name": docname,
+            "chunk": text,
+            "token_count": token_count if token_count is not None else num_tokens(text),
+            "roles": set(roles.split(",")) if roles else set(),
+            "has_steps": bool(has_steps),
+            "section_title": section_title,
+            "text_norm": text_norm if text_norm is not None else normalize_text(text),
+            "lemmas": set(lemmas.split()) if lemmas is not None else set(lemmatize(text)),
+            "position": position,
+            "prev_id": prev_id,
+            "next_id": next_id,
+            "duplicate_of": duplicate_of,
+            "sources": json.loads(sources) if sources else [docname],
+        })
+    return chunks
+
+
+def _read_profiles(conn):
+    profiles = []
+    for docname, title, headings, top_lemmas, heading_lemmas, chunk_count in conn.execute(
+        "SELECT document_name, title, headings, top_lemmas, heading_lemmas, chunk_count "
+        "FROM document_profiles ORDER BY document_name"
+    ):
+        profiles.append({
+            "document_name": docname,
+            "title": title,
+            "headings": json.loads(headings) if headings else [],
+            "top_lemmas": json.loads(top_lemmas) if top_lemmas else {},
+            "heading_lemmas": set(heading_lemmas.split()) if heading_lemmas else set(),
+            "chunk_count": chunk_count,
+        })
+    return profiles
+
+
+def load_chunks_from_db(db_path=DB_PATH, include_duplicates=False):
+    """Чанки без почти-дубликатов; sources — все файлы, где встречается текст.
+
+    С include_duplicates возвращаются и дубликаты (duplicate_of != None) —
+    они нужны для сборки контекста по соседям.
+    """
+    conn = connect_db(db_path)
+    try:
+        init_db(conn)
+        return _read_chunks(conn, include_duplicates)
+    finally:
+        conn.close()
+
+
+def load_corpus(db_path=DB_PATH, include_duplicates=True):
+    """(версия корпуса, чанки, профили документов) — из одного согласованного состояния базы"""
+    conn = connect_db(db_path)
+    try:
+        init_db(conn)
+        conn.execute("BEGIN")  # одна транзакция чтения: писатель не вклинится между запросами
+        try:
+            return _corpus_version(conn), _read_chunks(conn, include_duplicates), _read_profiles(conn)
+        finally:
+            conn.rollback()
+    finally:
+        conn.close()
+
+
+def search_chunks(query, limit=FTS_TOP_K, db_path=DB_PATH):
+    """Топ чанков по BM25 (FTS5 по леммам) без дубликатов: [(id, score)], лучшие первыми.
+
+    None — если FTS5 недоступен или индекс ещё не построен.
+    """
+    terms = sorted(set(lemmatize(query)))
+    if not terms:
+        return []
+    match = " OR ".join('"' + term.replace('"', '""') + '"' for term in terms)
+    conn = connect_db(db_path)
+    try:
+        return conn.execute(
+            "SELECT c.id, bm25(chunks_fts) AS score FROM chunks_fts "
+            "JOIN chunks c ON c.id = chunks_fts.rowid "
+            "WHERE chunks_fts MATCH ? AND c.duplicate_of IS NULL "
+            "ORDER BY score LIMIT ?",
+            (match, limit)
+        ).fetchall()
+    except sqlite3.OperationalError as e:
+        print(f"⚠️ Поиск по FTS недоступен: {e}")
+        return None
+    finally:
+        conn.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Индексация документов в bot_data.db")
+    parser.add_argument("--full", action="store_true", help="перепарсить все документы")
+    parser.add_argument(
+        "--workers", type=int, default=PARSE_WORKERS,
+        help="количество процессов парсинга (больше 1 — параллельный режим)"
+    )
+    args, _ = parser.parse_known_args(argv)
+    return args
+
+
+def count_chunks(db_path=DB_PATH):
+    conn = connect_db(db_path)
+    try:
+        init_db(conn)
+        return conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def main():
+    args = parse_args()
+    stats = sync_documents(DOCS_FOLDER, workers=args.workers, full=args.full)
+    stats["chunks"] = count_chunks()
+    print(f"✅ Обновлено документов: {stats['updated']}, удалено: {stats['deleted']}.")
+    print(f"✅ В базе: {stats['chunks']} чанков.")
+
+    return stats
+
+
+def parse_and_return_chunks(include_duplicates=False):
+    sync_documents(DOCS_FOLDER)
+    return load_chunks_from_db(include_duplicates=include_duplicates)
+
+def save_chunks_to_db(chunks):
+    """Полная перезапись таблицы через теневую; chunks — итерируемый источник (docname, text)"""
+    conn = connect_db(DB_PATH)
+    try:
+        init_db(conn)
+        _create_shadow(conn)
+        with conn:
+            rows = (
+                row
+                for docname, group in groupby(chunks, key=lambda item: item[0])
+                for row in _chunk_rows(docname, (Document(page_content=text) for _, text in group))
+            )
+            _insert_chunks(conn, SHADOW_TABLE, rows)
+            link_neighbours(conn, SHADOW_TABLE)
+        # манифест больше не соответствует таблице
+        _swap_in_shadow(conn, manifest_rows=[])
+    finally:
+        conn.close()
 
 if __name__ == "__main__":
     main()
@@ -11,17 +11,26 @@ import threading
 import asyncio
 import time
 import functools
-from collections import defaultdict
+import math
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from types import MappingProxyType
 from datetime import datetime, timedelta
-from typing import Dict, List, Tuple, Any, Optional, Set
+from typing import Dict, List, Tuple, Any, Optional, Set, Mapping
 import pickle
+try:
+    import faiss
+    import numpy as np
+except ImportError:  # без faiss бот ищет только по BM25
+    faiss = None
 import hashlib
+import sqlite3
 from pymorphy2 import MorphAnalyzer
 
 global synonyms_from_db
 
 BACKEND_URL = os.environ.get("BACKEND_URL", "http://backend:8000")
-from langchain_community.chat_models import ChatOpenAI
+from langchain_openai import ChatOpenAI
 from telegram import Update
 from telegram.ext import ApplicationBuilder, MessageHandler, ContextTypes, filters
 from tqdm import tqdm
@@ -32,9 +41,15 @@ from watchdog.events import FileSystemEventHandler
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton
 morph = MorphAnalyzer()
 
+@functools.lru_cache(maxsize=50_000)
+def normal_form(word: str) -> str:
+    """Начальная форма слова; разбор pymorphy2 запоминаем — слова вопросов повторяются"""
+    return morph.parse(word)[0].normal_form
+
+
 def normalize(text: str) -> List[str]:
     """Нормализует слова до начальной формы"""
-    return [morph.parse(word)[0].normal_form for word in re.findall(r'\b\w+\b', text.lower())]
+    return [normal_form(word) for word in re.findall(r'\b\w+\b', text.lower())]
 # === НАСТРОЙКИ ===
 TELEGRAM_TOKEN = os.environ.get("TELEGRAM_TOKEN")
 if not TELEGRAM_TOKEN:
@@ -54,8 +69,29 @@ os.environ["OPENAI_API_KEY"] = OPENAI_API_KEY
 ADMIN_IDS = [339948299]
 allowed_users = {}  # user_id -> role
 DOCS_FOLDER = "docs"
-MAX_TOKENS_PER_BLOCK = 2000
-docs = []
+CONTEXT_TOKEN_BUDGET = 600  # сколько токенов соседних чанков собираем вокруг найденного
+DOC_SHORTLIST_SIZE = 5  # сколько документов отбираем по профилям перед поиском по чанкам
+HEADING_LEMMA_WEIGHT = 1.0  # вес совпадения с названием или заголовком документа
+SEARCH_TOP_K = 10  # сколько лучших чанков проверяем на ответ в каждом проходе
+MAX_ANSWERS = 3  # после стольких годных ответов остальные запросы к GPT отменяем
+ASK_GPT_PARALLEL = os.environ.get("ASK_GPT_PARALLEL", "1") == "1"  # блоки проверяем параллельно
+# combined — все блоки одним запросом с указанием источника, per_block — запрос на каждый блок
+ANSWER_MODE = os.environ.get("ANSWER_MODE", "combined")
+ANSWER_BLOCKS_TOKEN_BUDGET = 3000  # сколько токенов блоков помещаем в общий промпт
+THINKING_TEXT = "⏳ Думаю..."
+STREAM_EDIT_INTERVAL = 1.0  # не чаще раза в секунду правим сообщение при стриминге (лимит Telegram)
+STREAM_PREVIEW_LIMIT = 3500  # длина черновика в одном сообщении (предел Telegram — 4096)
+STREAM_MIN_CHARS = 20  # черновик показываем, когда ясно, что это не «ответа нет»
+VECTOR_TOP_K = 30  # сколько ближайших чанков берём из FAISS
+VECTOR_INDEX_CHECK_INTERVAL = 30  # как часто (сек) проверяем, не пересобран ли индекс
+RRF_K = 60  # сглаживание в слиянии рангов BM25 и векторного поиска
+RERANK_MODEL = os.environ.get("RERANK_MODEL", "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1")
+RERANK_CANDIDATES = 30  # сколько кандидатов поиска оценивает cross-encoder
+RERANK_TOP_N = 3  # сколько лучших блоков уходит в GPT
+RERANK_THRESHOLD = float(os.environ.get("RERANK_THRESHOLD", "0.2"))  # ниже — «ничего не найдено» без GPT
+RERANK_BATCH_SIZE = 16
+CONFIG_REFRESH_INTERVAL = 300  # как часто (сек) фоном обновляем синонимы и приоритеты
+CORPUS_CHECK_INTERVAL = 10  # как часто (сек) сверяем версию корпуса в bot_data.db со снимком
 CP_FOLDER = r"\\srv-2\обмен\Отдел продаж\Наличие 2023_производство 2024"
 CRM_KEYWORDS = {"срм", "crm", "автодилер", "срмка"}
 CRM_DOCUMENTS = {
@@ -69,6 +105,9 @@ with open('law_keywords.json', 'r', encoding='utf-8') as f:
 # === КЭШИРОВАНИЕ И КАТАЛОГИ ===
 CACHE_DIR = "cache"
 CACHE_LIFETIME = 3600  # время жизни кэша в секундах (1 час)
+# Версия формата кэша настроек (индекс синонимов, приоритеты): при смене формата
+# увеличиваем, чтобы старый файл кэша не читался в новом виде
+CONFIG_CACHE_VERSION = 2
 
 # Проверка и создание необходимых каталогов
 for directory in [CACHE_DIR, DOCS_FOLDER]:
@@ -97,7 +136,168 @@ logger.setLevel(logging.INFO)
 # === КОДОВАЯ БАЗА ===
 encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
 synonyms_from_db = {}
+synonym_index = {"version": None, "groups": {}, "terms": {}, "lemmas": {}}  # см. /synonyms/index в backend
 priorities_from_db = {}
+keyword_matcher = None  # см. refresh_keyword_matcher
+_keyword_matcher_source = None
+
+
+# === LLM-КЛИЕНТ ===
+# Профили моделей: один долгоживущий ChatOpenAI на профиль
+LLM_MODELS = {
+    "answer": {"model": "gpt-3.5-turbo", "temperature": 0.2, "max_tokens": 1000, "max_retries": 3},
+    "priority": {"model": "gpt-3.5-turbo", "temperature": 0.1, "max_tokens": 1000, "max_retries": 3},
+}
+LLM_MAX_CONNECTIONS = 10  # пул keep-alive соединений к API, общий для всех воркеров
+LLM_KEEPALIVE_EXPIRY = 60
+try:
+    import h2  # noqa: F401 — нужен httpx для HTTP/2
+    LLM_HTTP2 = True
+except ImportError:
+    LLM_HTTP2 = False
+
+# Память ответов LLM: ключ — модель, шаблон с версией и хэш промпта (в промпте уже текст блоков)
+LLM_MEMO_PATH = os.path.join("cache", "llm_responses.db")
+LLM_MEMO_TTL = 7 * 24 * 3600  # сколько секунд ответ считается актуальным
+LLM_MEMO_MAX_ENTRIES = 20000  # сверх этого вытесняем давно не использованные
+LLM_MEMO_PRUNE_EVERY = 100  # чистим устаревшие раз в столько записей
+# Версии шаблонов: поднимаем, когда меняется разбор ответа, а не только текст промпта
+PROMPT_TEMPLATE_VERSIONS = {"answer": 1, "combined": 1, "choose_best": 1, "priority": 2}
+
+llm_http_client = None
+llm_clients = {}
+llm_memo = {"conn": None, "writes": 0}
+
+
+def get_llm(profile="answer"):
+    """Общий ChatOpenAI для профиля из LLM_MODELS; соединения переиспользуются между вызовами"""
+    global llm_http_client
+    llm = llm_clients.get(profile)
+    if llm is None:
+        if llm_http_client is None:
+            llm_http_client = httpx.AsyncClient(
+                http2=LLM_HTTP2,
+                timeout=httpx.Timeout(60.0, connect=10.0),
+                limits=httpx.Limits(
+                    max_connections=LLM_MAX_CONNECTIONS,
+                    max_keepalive_connections=LLM_MAX_CONNECTIONS,
+                    keepalive_expiry=LLM_KEEPALIVE_EXPIRY
+                )
+            )
+        llm = llm_clients[profile] = ChatOpenAI(**LLM_MODELS[profile], http_async_client=llm_http_client)
+    return llm
+
+
+def get_llm_memo():
+    conn = llm_memo["conn"]
+    if conn is None:
+        conn = sqlite3.connect(LLM_MEMO_PATH, timeout=5)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            model TEXT NOT NULL,
+            template TEXT NOT NULL,
+            response TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            last_used REAL NOT NULL
+        )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_used ON responses (last_used)")
+        conn.commit()
+        llm_memo["conn"] = conn
+    return conn
+
+
+def llm_memo_key(profile, template, prompt):
+    config = LLM_MODELS[profile]
+    parts = [
+        config["model"], str(config["temperature"]), str(config["max_tokens"]),
+        template, str(PROMPT_TEMPLATE_VERSIONS[template]), prompt
+    ]
+    return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+
+def llm_memo_get(key):
+    """Сохранённый ответ, если он не старше LLM_MEMO_TTL; отмечает использование для вытеснения"""
+    try:
+        conn = get_llm_memo()
+        now = time.time()
+        row = conn.execute(
+            "SELECT response FROM responses WHERE key = ? AND created_at > ?", (key, now - LLM_MEMO_TTL)
+        ).fetchone()
+        if row is None:
+            return None
+        with conn:
+            conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+        return row[0]
+    except sqlite3.Error as e:
+        logger.warning(f"⚠️ Ошибка чтения памяти ответов LLM: {e}")
+        return None
+
+
+def llm_memo_put(key, profile, template, response):
+    try:
+        conn = get_llm_memo()
+        now = time.time()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, template, response, created_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, LLM_MODELS[profile]["model"], template, response, now, now)
+            )
+        llm_memo["writes"] += 1
+        if llm_memo["writes"] % LLM_MEMO_PRUNE_EVERY == 0:
+            prune_llm_memo(conn, now)
+    except sqlite3.Error as e:
+        logger.warning(f"⚠️ Ошибка записи в память ответов LLM: {e}")
+
+
+def prune_llm_memo(conn, now):
+    """Удаляет устаревшие ответы и давно не использованные сверх LLM_MEMO_MAX_ENTRIES"""
+    with conn:
+        expired = conn.execute("DELETE FROM responses WHERE created_at <= ?", (now - LLM_MEMO_TTL,)).rowcount
+        evicted = conn.execute(
+            "DELETE FROM responses WHERE key IN "
+            "(SELECT key FROM responses ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (LLM_MEMO_MAX_ENTRIES,)
+        ).rowcount
+    if expired or evicted:
+        logger.info(f"🧹 Память ответов LLM: устаревших {expired}, вытеснено {evicted}")
+
+
+async def complete(prompt, template, profile="answer", on_text=None):
+    """Запрос к LLM через память ответов; если задан on_text, ответ стримится и on_text получает накопленный текст"""
+    key = llm_memo_key(profile, template, prompt)
+    memo = llm_memo_get(key)
+    if memo is not None:
+        return memo
+
+    llm = get_llm(profile)
+    if on_text is None:
+        response = await llm.ainvoke(prompt)
+        text = response.content.strip()
+    else:
+        text = ""
+        async for chunk in llm.astream(prompt):
+            text += chunk.content
+            await on_text(text)
+        text = text.strip()
+    llm_memo_put(key, profile, template, text)
+    return text
+
+
+async def close_llm_clients(app=None):
+    """Закрывает общий HTTP-клиент LLM при остановке бота"""
+    global llm_http_client
+    llm_clients.clear()
+    if llm_memo["conn"] is not None:
+        llm_memo["conn"].close()
+        llm_memo["conn"] = None
+    if llm_http_client is not None:
+        await llm_http_client.aclose()
+        llm_http_client = None
 
 
 # === ФУНКЦИЯ ПОВТОРНЫХ ПОПЫТОК ===
@@ -154,46 +354,53 @@ def load_cache(key: str) -> Optional[Any]:
     return None
 
 
-async def cached(func, *args, **kwargs):
-    """Обертка для кэширования результатов функции"""
-    func_name = func.__name__
-    cache_key = get_cache_key(func_name, *args, **kwargs)
-
-    # Проверяем кэш
-    cached_result = load_cache(cache_key)
-    if cached_result is not None:
-        logger.info(f"Данные получены из кэша: {func_name}")
-        return cached_result
-
-    # Выполняем функцию
-    result = await func(*args, **kwargs)
-
-    # Сохраняем результат в кэш
-    save_cache(cache_key, result)
-    return result
+# === ЗАГРУЗКА ДИНАМИЧЕСКИХ ДАННЫХ ===
+def fallback_synonym_index(groups: Dict[str, List[str]]) -> Dict[str, Any]:
+    """Упрощённый индекс синонимов, если backend не отдал /synonyms/index.
+
+    Только groups и terms, без лемм: полный индекс строит backend
+    (build_synonym_index в backend/main.py).
+    """
+    terms = {}
+    for keyword, synonyms in groups.items():
+        for term in [keyword, *synonyms]:
+            keys = terms.setdefault(term.lower().strip(), [])
+            if keyword not in keys:
+                keys.append(keyword)
+    version = hashlib.sha1(json.dumps(groups, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()[:12]
+    return {"version": version, "groups": groups, "terms": terms, "lemmas": {}}
+
+
+def synonym_groups(word: str, use_lemma: bool = False) -> List[str]:
+    """Группы синонимов (ключевые слова), в которые входит слово"""
+    groups = synonym_index["terms"].get(word)
+    if groups is None and use_lemma:
+        groups = synonym_index["lemmas"].get(normal_form(word))
+    return groups or []
 
 
-# === ЗАГРУЗКА ДИНАМИЧЕСКИХ ДАННЫХ ===
 async def load_dynamic_data():
-    global synonyms_from_db, priorities_from_db
+    global synonyms_from_db, synonym_index, priorities_from_db
     logger.info("🔄 Начата загрузка динамических данных")
     #logger.info(f"🧪 Получены приоритеты из API: {prio.text}") #временно
 
     async def _load_data():
         async with httpx.AsyncClient(timeout=30.0) as client:
-            logger.info("📥 Запрос синонимов из API")
-            syns = await client.get(f"{BACKEND_URL}/synonyms_from_db")
-            syns.raise_for_status()
-            logger.info(f"✅ Получен ответ о синонимах, статус: {syns.status_code}")
-
-            synonyms = {}
-            for item in syns.json():
-                key = item["keyword"]
-                val = item["synonym"]
-                logger.info(f"🔄 Синоним добавлен: {key} → {val}")
-
-                synonyms.setdefault(key, []).append(val)
-            logger.info(f"📊 Загружено синонимов: {len(synonyms)} ключевых слов")
+            logger.info("📥 Запрос индекса синонимов из API")
+            syns = await client.get(f"{BACKEND_URL}/synonyms/index")
+            if syns.status_code == 404:
+                # backend без готового индекса — собираем упрощённый из списка синонимов
+                syns = await client.get(f"{BACKEND_URL}/synonyms_from_db")
+                syns.raise_for_status()
+                groups = {}
+                for item in syns.json():
+                    if item["synonym"] not in groups.setdefault(item["keyword"], []):
+                        groups[item["keyword"]].append(item["synonym"])
+                index = fallback_synonym_index(groups)
+            else:
+                syns.raise_for_status()
+                index = syns.json()
+            logger.info(f"📊 Загружено синонимов: {len(index['groups'])} ключевых слов, версия {index['version']}")
 
             logger.info("📥 Запрос приоритетов из API")
             prio = await client.get(f"{BACKEND_URL}/priorities")
@@ -210,12 +417,28 @@ async def load_dynamic_data():
 
             logger.info(f"📌 Обновлённые приоритеты для CRM: {CRM_DOCUMENTS}")
             logger.info(f"📊 Загружено приоритетов: {len(priorities)} ключевых слов")
-            return synonyms, priorities
+            return index, priorities
 
+    # Настройки всегда берём из backend; кэш — только запасной вариант при холодном старте
+    cache_key = get_cache_key("dynamic_config", CONFIG_CACHE_VERSION)
     try:
-        synonyms, priorities = await cached(_load_data)
-        synonyms_from_db = synonyms
+        try:
+            index, priorities = await _load_data()
+            save_cache(cache_key, (index, priorities))
+        except Exception as e:
+            if synonym_index["version"] is not None:
+                # Уже работаем на загруженных настройках — оставляем их до следующей попытки
+                logger.error(f"⚠️ Backend недоступен, оставляем прежние синонимы и приоритеты: {e}")
+                return
+            cached_data = load_cache(cache_key)
+            if cached_data is None:
+                raise
+            logger.warning(f"⚠️ Backend недоступен, синонимы и приоритеты взяты из кэша: {e}")
+            index, priorities = cached_data
+        synonym_index = index
+        synonyms_from_db = index["groups"]
         priorities_from_db = priorities
+        refresh_keyword_matcher()
 
         logger.info(f"📊 Загружено приоритетов: {len(priorities_from_db)}") #временное логирование
         for keyword, doc_name in priorities_from_db.items(): #временное логирование
@@ -242,6 +465,37 @@ async def load_dynamic_data():
             "заменять": ["замещает", "исполняет обязанности", "выполняет обязанности", "подменяет", "заменяет"],
             "одежда": ["одежда", "дресс-код", "внешний вид", "джинсы", "шорты", "майка", "футболка", "форма"],
         }
+        synonym_index = fallback_synonym_index(synonyms_from_db)
+        refresh_keyword_matcher()
+
+
+async def refresh_config_periodically():
+    """Фоновое обновление синонимов и приоритетов — вопросы их больше не перезагружают"""
+    while True:
+        await asyncio.sleep(CONFIG_REFRESH_INTERVAL)
+        try:
+            await load_dynamic_data()
+        except Exception as e:
+            logger.error(f"⚠️ Ошибка фонового обновления настроек: {e}")
+
+
+async def watch_corpus_version():
+    """Подхватывает изменения bot_data.db, сделанные не через watchdog бота.
+
+    parse_documents.py --full или vectorize_chunks.py, запущенные отдельно,
+    меняют чанки и FTS; как только версия корпуса в базе разошлась со
+    снимком, перечитываем снимок из базы (без повторной синхронизации).
+    """
+    from parse_documents import read_corpus_version
+    while True:
+        await asyncio.sleep(CORPUS_CHECK_INTERVAL)
+        try:
+            db_version = await asyncio.to_thread(read_corpus_version)
+            if db_version != corpus.db_version:
+                logger.info(f"📚 Версия корпуса в базе {db_version}, в снимке {corpus.db_version} — обновляем снимок")
+                await asyncio.to_thread(refresh_corpus, False)
+        except Exception as e:
+            logger.error(f"⚠️ Ошибка проверки версии корпуса: {e}")
 
 
 async def load_allowed_users():
@@ -294,34 +548,35 @@ class DocsChangeHandler(FileSystemEventHandler):
             now = time.time()
             if now - last_update_time > 10:  # Прошло больше 10 секунд с последнего обновления
                 logger.info(f"📄 Обнаружено изменение: {event.src_path}, обновляем...")
-                cache_key = get_cache_key("load_docs")
-                cache_path = os.path.join(CACHE_DIR, f"{cache_key}.pkl")
-                if os.path.exists(cache_path):
-                    os.remove(cache_path)
-                threading.Thread(target=lambda: asyncio.run(update_docs()), daemon=True).start()
+                threading.Thread(target=refresh_corpus, daemon=True).start()
                 last_update_time = now
             else:
                 pass
 
 
-async def update_docs():
-    """Обновление документов с использованием кеширования"""
-    global docs
-    # Используем синхронную версию загрузки документов
-    docs = await cached(lambda: asyncio.to_thread(load_docs))
+def refresh_corpus(sync: bool = True) -> bool:
+    """Собирает новый снимок корпуса и атомарно подменяет текущий.
+
+    sync — сначала синхронизировать базу с папкой docs. Если загрузка
+    не удалась, остаётся прежний снимок.
+    """
+    global corpus
+    with corpus_lock:
+        snapshot = load_docs(corpus.version + 1, sync)
+        if snapshot is None:
+            return False
+        corpus = snapshot
+    logger.info(
+        f"📚 Корпус обновлён: версия {snapshot.version} (в базе {snapshot.db_version}), {len(snapshot.chunks)} чанков"
+    )
+    return True
 
 
 def start_watchdog():
     """Запуск наблюдателя за документами"""
     print("📄 Начало инициализации наблюдателя...")
     try:
-        # Сначала загружаем документы без watchdog
-        print("   Загрузка документов...")
-        global docs
-        docs = load_docs()  # Сканируем один раз
-        print(f"   ✅ Загружено {len(docs)} документов")
-
-        # Затем настраиваем наблюдателя
+        # Документы загружает on_startup, здесь только настраиваем наблюдателя
         print("   Настройка наблюдателя...")
         handler = DocsChangeHandler()
         observer = Observer()
@@ -342,19 +597,342 @@ def start_watchdog():
         return False
 
 
-def load_docs():
-    """Загружает и разбивает документы на чанки через parse_documents.py"""
+def normalize_doc_name(name: str) -> str:
+    return unicodedata.normalize('NFKD', name).lower().strip()
+
+
+@dataclass(frozen=True)
+class CorpusSnapshot:
+    """Неизменяемый снимок корпуса с индексами; при изменениях подменяется целиком.
+
+    Обработчик вопроса берёт ссылку на снимок один раз и работает с ней до конца.
+    """
+    version: int
+    db_version: int  # версия корпуса в bot_data.db, из которой собран снимок
+    chunks: Tuple[Dict[str, Any], ...]
+    by_id: Mapping[int, Dict[str, Any]]
+    by_role: Mapping[str, frozenset]
+    by_doc: Mapping[str, Tuple[Dict[str, Any], ...]]
+    by_lemma: Mapping[str, frozenset]
+    profiles: Mapping[str, Dict[str, Any]]
+    idf: Mapping[str, float]
+
+
+corpus = CorpusSnapshot(0, -1, (), *(MappingProxyType({}) for _ in range(6)))  # см. load_docs
+corpus_lock = threading.Lock()
+
+
+def load_docs(version: int = 1, sync: bool = True) -> Optional[CorpusSnapshot]:
+    """Синхронизирует документы (если sync) и читает корпус из bot_data.db через parse_documents.py.
+
+    Возвращает снимок корпуса (None — если загрузка не удалась): chunks — чанки-словари (id, нормализованное
+    имя файла name, текст chunk, sources — все файлы, где встречается текст,
+    и признаки из индексации: roles, has_steps, section_title, text_norm,
+    prev_id/next_id — соседи по документу), by_id — все чанки по id (включая
+    почти-дубликаты, нужные для сборки контекста; content_hash — хэш текста,
+    как в FAISS-индексе), by_role — роль -> id чанков
+    с заголовком этой роли, by_doc — документ -> его чанки, by_lemma — лемма ->
+    id чанков (леммы посчитаны при индексации), profiles и idf —
+    профили документов и редкость их лемм для грубого отбора документов.
+    """
     print("📄 Загрузка и разбиение документов...")
     try:
-        from parse_documents import parse_and_return_chunks
-        chunks = parse_and_return_chunks()
-        print(f"✅ Загружено {len(chunks)} чанков")
-        return chunks
+        from parse_documents import sync_documents, load_corpus, text_hash
+        if sync:
+            sync_documents()
+        # Чанки, профили и версия — из одного состояния базы
+        db_version, all_chunks, profile_list = load_corpus(include_duplicates=True)
+        chunks = []
+        by_role = defaultdict(set)
+        by_doc = defaultdict(list)
+        by_lemma = defaultdict(set)
+        for chunk in all_chunks:
+            chunk["name"] = normalize_doc_name(chunk["document_name"])
+            chunk["content_hash"] = text_hash(chunk["chunk"])
+            chunk["sources"] = [normalize_doc_name(source) for source in chunk["sources"]]
+            if chunk["duplicate_of"] is not None:
+                continue
+            chunks.append(chunk)
+            for role in chunk["roles"]:
+                by_role[role].add(chunk["id"])
+            for source in chunk["sources"]:
+                by_doc[source].append(chunk)
+            for lemma in chunk["lemmas"]:
+                by_lemma[lemma].add(chunk["id"])
+
+        profiles = {}
+        document_frequency = defaultdict(int)
+        for profile in profile_list:
+            top_weight = max(profile["top_lemmas"].values(), default=1.0)
+            profile["lemma_weights"] = {lemma: w / top_weight for lemma, w in profile["top_lemmas"].items()}
+            profiles[normalize_doc_name(profile["document_name"])] = profile
+            for lemma in profile["lemma_weights"].keys() | profile["heading_lemmas"]:
+                document_frequency[lemma] += 1
+        idf = {lemma: math.log(1 + len(profiles) / df) for lemma, df in document_frequency.items()}
+
+        print(f"✅ Загружено {len(chunks)} чанков, профилей документов: {len(profiles)}")
+        return CorpusSnapshot(
+            version=version,
+            db_version=db_version,
+            chunks=tuple(chunks),
+            by_id=MappingProxyType({c["id"]: c for c in all_chunks}),
+            by_role=MappingProxyType({role: frozenset(ids) for role, ids in by_role.items()}),
+            by_doc=MappingProxyType({name: tuple(items) for name, items in by_doc.items()}),
+            by_lemma=MappingProxyType({lemma: frozenset(ids) for lemma, ids in by_lemma.items()}),
+            profiles=MappingProxyType(profiles),
+            idf=MappingProxyType(idf),
+        )
     except Exception as e:
         print(f"❌ Ошибка при загрузке документов: {e}")
-        return []
+        return None
 
 
+def rank_documents(question_lemmas: Set[str], profiles: Dict[str, Dict[str, Any]],
+                   idf: Dict[str, float], limit: int = DOC_SHORTLIST_SIZE) -> List[str]:
+    """Грубый отбор: документы, чьи частые леммы и заголовки лучше всего покрывают вопрос"""
+    scores = []
+    for name, profile in profiles.items():
+        score = sum(
+            idf.get(lemma, 0.0) * (
+                profile["lemma_weights"].get(lemma, 0.0)
+                + (HEADING_LEMMA_WEIGHT if lemma in profile["heading_lemmas"] else 0.0)
+            )
+            for lemma in question_lemmas
+        )
+        if score > 0:
+            scores.append((score, name))
+    scores.sort(reverse=True)
+    return [name for _, name in scores[:limit]]
+
+
+def _merge_overlap(left: str, right: str, max_overlap: int = 600, min_overlap: int = 10) -> str:
+    """Склеивает соседние чанки, убирая перекрытие сплиттера"""
+    for size in range(min(len(left), len(right), max_overlap), min_overlap - 1, -1):
+        if left.endswith(right[:size]):
+            return left + right[size:]
+    return left + "\n" + right
+
+
+def assemble_context(chunk: Dict[str, Any], by_id: Dict[int, Dict[str, Any]],
+                     budget: int = CONTEXT_TOKEN_BUDGET) -> Tuple[str, Set[int], int]:
+    """Расширяет найденный чанк соседями по документу, пока хватает бюджета токенов.
+
+    Соседей добавляем поочерёдно справа и слева. Если окно начинается внутри
+    раздела, перед текстом ставим заголовок раздела (section_title из индексации).
+    Возвращает текст блока, id всех вошедших в него чанков и число токенов
+    (сумма посчитанных при индексации, с перекрытием соседей — оценка сверху).
+    """
+    window = [chunk]
+    tokens = chunk["token_count"]
+    left, right = by_id.get(chunk["prev_id"]), by_id.get(chunk["next_id"])
+
+    while left is not None or right is not None:
+        if right is not None:
+            if tokens + right["token_count"] <= budget:
+                window.append(right)
+                tokens += right["token_count"]
+                right = by_id.get(right["next_id"])
+            else:
+                right = None
+        if left is not None:
+            if tokens + left["token_count"] <= budget:
+                window.insert(0, left)
+                tokens += left["token_count"]
+                left = by_id.get(left["prev_id"])
+            else:
+                left = None
+
+    text = window[0]["chunk"]
+    for neighbour in window[1:]:
+        text = _merge_overlap(text, neighbour["chunk"])
+    section = window[0]["section_title"]
+    if section and section not in text:
+        text = f"**{section}**\n{text}"
+        tokens += num_tokens(section) + 2
+    return text, {c["id"] for c in window}, tokens
+
+
+def chunks_for_documents(by_doc: Dict[str, List[Dict[str, Any]]], names, key=None) -> List[Dict[str, Any]]:
+    """Слияние списков чанков документов names без повторов.
+
+    Без key — документы по порядку names. С key — все чанки по key,
+    а порядок names лишь разрешает равенство (сортировка устойчивая).
+    """
+    seen = set()
+    result = []
+    for name in names:
+        for chunk in by_doc.get(name, []):
+            if chunk["id"] not in seen:
+                seen.add(chunk["id"])
+                result.append(chunk)
+    if key is not None:
+        result.sort(key=key)
+    return result
+
+
+
+# === ВЕКТОРНЫЙ ПОИСК (FAISS) ===
+# Индекс строит vectorize_chunks.py; подменяем его на лету, когда меняется chunk_ids.json.
+# Строки индекса сверяем со снимком корпуса: чанк с другим текстом (или удалённый) не ищем
+vector_index = {
+    "index": None, "chunk_ids": [], "content_hashes": [], "mtime": None, "checked_at": 0.0,
+    "valid_rows": None, "valid_for": None,
+}
+vector_lock = threading.Lock()
+_embedding_model = None
+_embedding_failed = False
+_vector_search_error = None
+
+
+def get_embedding_model():
+    """Модель эмбеддингов вопроса; None — если модель недоступна"""
+    global _embedding_model, _embedding_failed
+    if _embedding_model is None and not _embedding_failed:
+        try:
+            from langchain_community.embeddings import HuggingFaceEmbeddings
+            from parse_documents import EMBEDDING_MODEL
+            _embedding_model = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL)
+        except Exception as e:
+            _embedding_failed = True
+            logger.warning(f"⚠️ Векторный поиск отключён, ищем только по BM25: {e}")
+    return _embedding_model
+
+
+def _read_faiss_index(path: str):
+    """Читает индекс через mmap, если тип индекса это поддерживает"""
+    try:
+        return faiss.read_index(path, faiss.IO_FLAG_MMAP)
+    except Exception:
+        return faiss.read_index(path)
+
+
+def refresh_vector_index() -> None:
+    """Перечитывает FAISS-индекс, если vectorize_chunks.py записал новый"""
+    if faiss is None:
+        return
+    from parse_documents import FAISS_INDEX_PATH, CHUNK_IDS_FILE
+    now = time.time()
+    if now - vector_index["checked_at"] < VECTOR_INDEX_CHECK_INTERVAL:
+        return
+    with vector_lock:
+        if now - vector_index["checked_at"] < VECTOR_INDEX_CHECK_INTERVAL:
+            return
+        vector_index["checked_at"] = now
+        ids_path = os.path.join(FAISS_INDEX_PATH, CHUNK_IDS_FILE)
+        try:
+            mtime = os.path.getmtime(ids_path)
+            if mtime == vector_index["mtime"]:
+                return
+            with open(ids_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            if not isinstance(meta, dict):
+                # Старый формат без хэшей: сверить со снимком нельзя, ждём новой векторизации
+                logger.warning("⚠️ FAISS-индекс без хэшей чанков — не используем, запустите vectorize_chunks.py")
+                vector_index.update(index=None, chunk_ids=[], content_hashes=[], mtime=mtime, valid_for=None)
+                return
+            chunk_ids, content_hashes = meta["chunk_ids"], meta["content_hashes"]
+            index = _read_faiss_index(os.path.join(FAISS_INDEX_PATH, "index.faiss"))
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.error(f"❌ Не удалось загрузить FAISS-индекс: {e}")
+            return
+        if index.ntotal != len(chunk_ids):
+            # Индекс ещё дописывается — оставляем прежний до следующей проверки
+            logger.warning(f"⚠️ FAISS-индекс ({index.ntotal}) не совпадает с chunk_ids ({len(chunk_ids)})")
+            return
+        vector_index.update(
+            index=index, chunk_ids=chunk_ids, content_hashes=content_hashes, mtime=mtime, valid_for=None
+        )
+        logger.info(f"🧭 Загружен FAISS-индекс: {index.ntotal} векторов")
+
+
+def _valid_vector_rows(snapshot: CorpusSnapshot):
+    """Строки индекса, чей чанк есть в снимке с тем же текстом (считается раз на индекс и снимок)"""
+    with vector_lock:
+        key = (vector_index["mtime"], snapshot.version)
+        if vector_index["valid_for"] != key:
+            by_id = snapshot.by_id
+            valid_rows = frozenset(
+                row for row, (chunk_id, digest) in enumerate(zip(vector_index["chunk_ids"], vector_index["content_hashes"]))
+                if chunk_id in by_id and by_id[chunk_id]["content_hash"] == digest
+            )
+            stale = len(vector_index["chunk_ids"]) - len(valid_rows)
+            if stale:
+                logger.warning(f"⚠️ FAISS-индекс устарел для {stale} чанков — они не участвуют в поиске")
+            vector_index.update(valid_rows=valid_rows, valid_for=key)
+        return vector_index["index"], vector_index["chunk_ids"], vector_index["valid_rows"]
+
+
+def vector_search(question: str, snapshot: CorpusSnapshot,
+                  k: int = VECTOR_TOP_K) -> Optional[List[Tuple[int, float]]]:
+    """Ближайшие к вопросу чанки снимка: [(id, расстояние)], лучшие первыми; None — индекса нет.
+
+    Любой сбой не мешает ответу: возвращаем None, и вопрос ищется только по BM25.
+    """
+    global _vector_search_error
+    try:
+        refresh_vector_index()
+        index, chunk_ids, valid_rows = _valid_vector_rows(snapshot)
+        if index is None or not valid_rows:
+            return None
+        model = get_embedding_model()
+        if model is None:
+            return None
+        query = np.array([model.embed_query(question)], dtype="float32")
+        # Запрашиваем с запасом на устаревшие строки, чтобы после отсева осталось k
+        stale = index.ntotal - len(valid_rows)
+        distances, rows = index.search(query, min(k + stale, index.ntotal))
+    except Exception as e:
+        # Одну и ту же ошибку пишем в лог один раз, а не на каждый вопрос
+        if str(e) != _vector_search_error:
+            _vector_search_error = str(e)
+            logger.error(f"❌ Ошибка векторного поиска, ищем только по BM25: {e}")
+        return None
+    _vector_search_error = None
+    hits = [(chunk_ids[row], float(dist)) for dist, row in zip(distances[0], rows[0]) if row in valid_rows]
+    return hits[:k]
+
+
+def fuse_rankings(*rankings: List[int]) -> Dict[int, int]:
+    """Слияние ранжированных списков id (reciprocal rank fusion): id -> итоговая позиция"""
+    scores = defaultdict(float)
+    for ranking in rankings:
+        for position, chunk_id in enumerate(ranking):
+            scores[chunk_id] += 1.0 / (RRF_K + position + 1)
+    ordered = sorted(scores, key=scores.get, reverse=True)
+    return {chunk_id: position for position, chunk_id in enumerate(ordered)}
+
+
+# === ПЕРЕРАНЖИРОВАНИЕ (cross-encoder на CPU) ===
+_reranker = None
+_reranker_failed = False
+
+
+def get_reranker():
+    """Cross-encoder для переранжирования; None — если модель недоступна"""
+    global _reranker, _reranker_failed
+    if _reranker is None and not _reranker_failed:
+        try:
+            from sentence_transformers import CrossEncoder
+            _reranker = CrossEncoder(RERANK_MODEL, max_length=512, device="cpu")
+            logger.info(f"🎯 Загружен cross-encoder: {RERANK_MODEL}")
+        except Exception as e:
+            _reranker_failed = True
+            logger.warning(f"⚠️ Переранжирование отключено: {e}")
+    return _reranker
+
+
+def rerank(question: str, chunks: List[Dict[str, Any]]) -> Optional[List[Tuple[float, Dict[str, Any]]]]:
+    """Оценки пар (вопрос, чанк) одним батчем: [(score, chunk)], лучшие первыми; None — без модели"""
+    model = get_reranker()
+    if model is None:
+        return None
+    if not chunks:
+        return []
+    scores = model.predict([(question, chunk["chunk"]) for chunk in chunks], batch_size=RERANK_BATCH_SIZE)
+    return sorted(zip((float(score) for score in scores), chunks), key=lambda pair: pair[0], reverse=True)
+
 
 # === ОГРАНИЧЕНИЕ ЧАСТОТЫ ЗАПРОСОВ ===
 async def check_rate_limit(user_id: int) -> bool:
@@ -383,11 +961,15 @@ async def worker():
             if task_data is None:
                 continue
 
-            update, context, question, user_id, username = task_data
+            update, context, question, user_id, username, thinking = task_data
 
-            # Выполняем задачу в ограниченном количестве
-            async with api_semaphore:
-                await process_question(update, context, question, user_id, username)
+            # Параллельность вопросов ограничена числом воркеров, запросов к API — семафором в ask_gpt
+            try:
+                await process_question(update, context, question, user_id, username, thinking)
+            except Exception:
+                # Не оставляем «Думаю...» висеть при сбое обработки
+                await reply_in_place(update, thinking, "⚠️ Не удалось обработать вопрос, попробуйте ещё раз.")
+                raise
 
             # Отмечаем задачу как выполненную
             processing_queue.task_done()
@@ -458,123 +1040,138 @@ async def handle_cp_request(update: Update, context: ContextTypes.DEFAULT_TYPE,
 
 
 
-async def check_override(question: str):
-    async def _get_overrides():
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.get(f"{BACKEND_URL}/overrides")
-            response.raise_for_status()
-            return response.json()
-
-    try:
-        # Загружаем синонимы, если они еще не загружены
-        if not synonyms_from_db:
-            await load_dynamic_data()
-
-        logger.info(f"🔄 Загруженные синонимы: {synonyms_from_db}")
-
-        # Приводим к нижнему регистру и убираем лишние знаки
-        question_lower = question.lower().replace('-', ' ').replace('?', '').replace('!', '').strip()
-        question_words = question_lower.split()
-
-        # Создаем обратную карту синонимов для более быстрого поиска
-        reverse_synonyms = {}
-        for key, values in synonyms_from_db.items():
-            for value in values:
-                if value not in reverse_synonyms:
-                    reverse_synonyms[value] = []
-                reverse_synonyms[value].append(key)
+# === РУЧНЫЕ ОТВЕТЫ (OVERRIDES) ===
+OVERRIDES_REFRESH_INTERVAL = 60  # как часто (сек) перечитываем ручные ответы из backend
+OVERRIDE_STOP_WORDS = {"если", "что", "как", "ли", "можно", "нужно", "и", "а", "но", "то", "по", "на", "в", "из",
+                       "при", "за", "кто", "где", "когда", "почему", "зачем", "должен", "должны", "должна", "мне",
+                       "вам"}
+override_state = {"matcher": None, "fingerprint": None, "loaded_at": 0.0, "task": None}
 
-        # Логируем для отладки
-        logger.info(f"🔄 Обратная карта синонимов: {reverse_synonyms}")
 
-        # Получаем ручные ответы
-        overrides = await retry_async(lambda: _get_overrides())
+def normalize_override_question(text: str) -> str:
+    # Приводим к нижнему регистру и убираем лишние знаки
+    return text.lower().replace('-', ' ').replace('?', '').replace('!', '').strip()
 
-        for item in overrides:
-            # Подготовка эталонного вопроса
-            item_question = item["question"].lower().replace('-', ' ').replace('?', '').replace('!', '').strip()
-            item_words = item_question.split()
 
+def override_semantic_set(words: List[str]) -> Set[str]:
+    """Значимые слова вопроса вместе с их группами синонимов"""
+    semantic = set()
+    for word in words:
+        if word in OVERRIDE_STOP_WORDS:
+            continue
+        # Добавляем само слово
+        semantic.add(word)
+        # Добавляем ключевые слова групп, где слово — синоним,
+        # и синонимы, если это само ключевое слово
+        for key in synonym_groups(word):
+            semantic.add(key)
+            if key == word:
+                semantic.update(synonyms_from_db[key])
+    return semantic
+
+
+class OverrideMatcher:
+    """Ручные ответы в памяти: точные совпадения — по хэшу, остальные —
+    кандидаты из инвертированного индекса по семантическим токенам.
+
+    Правила совпадения прежние: побеждает первый по порядку ручной ответ,
+    подходящий по точному совпадению, по Жаккару или по правилу коротких вопросов.
+    """
+
+    def __init__(self, overrides: List[Dict[str, Any]]):
+        self.items = []  # (ответ, семантическое множество) в порядке backend
+        self.exact = {}  # нормализованный вопрос -> позиция первого такого ответа
+        self.postings = defaultdict(list)  # токен -> позиции ответов
+        for position, item in enumerate(overrides):
+            item_question = normalize_override_question(item["question"])
+            semantic_set_item = override_semantic_set(item_question.split())
+            self.items.append((item["answer"], semantic_set_item))
+            self.exact.setdefault(item_question, position)
+            for token in semantic_set_item:
+                self.postings[token].append(position)
+
+    def match(self, question: str) -> Optional[str]:
+        question_lower = normalize_override_question(question)
+        question_words = question_lower.split()
+        significant_question_words = [w for w in question_words if w not in OVERRIDE_STOP_WORDS]
+        if not significant_question_words and self.items:
+            # Как и раньше: правило коротких вопросов срабатывает на первом же ответе
+            return self.items[0][0]
+
+        semantic_set_question = override_semantic_set(question_words)
+        exact = self.exact.get(question_lower)
+        candidates = {exact} if exact is not None else set()
+        for token in semantic_set_question:
+            candidates.update(self.postings.get(token, ()))
+
+        for position in sorted(candidates):
+            answer, semantic_set_item = self.items[position]
             # 1. Проверка на точное совпадение
-            if question_lower == item_question:
+            if position == exact:
                 logger.info(f"✅ Найдено точное совпадение вопроса: {question}")
-                return item["answer"]
+                return answer
 
             # 2. Проверка с учетом синонимов
-            # Расширенный список стоп-слов
-            stop_words = {"если", "что", "как", "ли", "можно", "нужно", "и", "а", "но", "то", "по", "на", "в", "из",
-                          "при", "за", "кто", "где", "когда", "почему", "зачем", "должен", "должны", "должна", "мне",
-                          "вам"}
-
-            # Строим семантические множества для обоих вопросов
-            semantic_set_question = set()
-            semantic_set_item = set()
-
-            # Обрабатываем слова из вопроса пользователя
-            for word in question_words:
-                if word in stop_words:
-                    continue
-
-                # Добавляем само слово
-                semantic_set_question.add(word)
-
-                # Добавляем ключевые слова, если это синоним
-                if word in reverse_synonyms:
-                    for key in reverse_synonyms[word]:
-                        semantic_set_question.add(key)
-
-                # Добавляем синонимы, если это ключевое слово
-                if word in synonyms_from_db:
-                    for synonym in synonyms_from_db[word]:
-                        semantic_set_question.add(synonym)
-
-            # Обрабатываем слова из эталонного вопроса
-            for word in item_words:
-                if word in stop_words:
-                    continue
-
-                # Добавляем само слово
-                semantic_set_item.add(word)
-
-                # Добавляем ключевые слова, если это синоним
-                if word in reverse_synonyms:
-                    for key in reverse_synonyms[word]:
-                        semantic_set_item.add(key)
-
-                # Добавляем синонимы, если это ключевое слово
-                if word in synonyms_from_db:
-                    for synonym in synonyms_from_db[word]:
-                        semantic_set_item.add(synonym)
-
-            # Находим общие семантические элементы
-            common_semantic = semantic_set_question.intersection(semantic_set_item)
-
-            # Считаем процент совпадения
-            all_semantic = semantic_set_question.union(semantic_set_item)
-            if all_semantic:
-                match_percent = len(common_semantic) / len(all_semantic)
-            else:
-                match_percent = 0
-
-            # Логируем для отладки
-            #logger.info(f"Вопрос пользователя: {question_lower}")
-            #logger.info(f"Семантический набор пользователя: {semantic_set_question}")
-            #logger.info(f"Вопрос в базе: {item_question}")
-            #logger.info(f"Семантический набор базы: {semantic_set_item}")
-            #logger.info(f"Общие семантические элементы: {common_semantic}")
-            #logger.info(f"Процент совпадения: {match_percent:.2f}")
+            common_semantic = semantic_set_question & semantic_set_item
+            all_semantic = semantic_set_question | semantic_set_item
+            match_percent = len(common_semantic) / len(all_semantic) if all_semantic else 0
 
             # Требуем минимум 2 общих элемента и 50% совпадение
             if len(common_semantic) >= 2 and match_percent >= 0.5:
                 logger.info(f"✅ Найдено хорошее семантическое совпадение: {common_semantic}")
-                return item["answer"]
+                return answer
 
             # Особый случай для очень коротких вопросов (2-3 слова)
-            # Если большинство слов из вопроса пользователя содержатся в эталонном вопросе
-            significant_question_words = [w for w in question_words if w not in stop_words]
             if len(significant_question_words) <= 3 and len(common_semantic) >= len(significant_question_words) * 0.67:
                 logger.info(f"✅ Найдено совпадение для короткого вопроса: {common_semantic}")
-                return item["answer"]
+                return answer
+
+        return None
+
+
+async def refresh_override_matcher():
+    """Перечитывает ручные ответы; индекс пересобирается, только если они
+    (или синонимы) изменились"""
+    async def _get_overrides():
+        async with httpx.AsyncClient(timeout=30.0) as client:
+            response = await client.get(f"{BACKEND_URL}/overrides")
+            response.raise_for_status()
+            return response.json()
+
+    overrides = await retry_async(lambda: _get_overrides())
+    override_state["loaded_at"] = time.time()
+    fingerprint = hashlib.sha1(
+        (json.dumps(overrides, sort_keys=True, ensure_ascii=False) + str(synonym_index["version"])).encode("utf-8")
+    ).hexdigest()
+    if fingerprint != override_state["fingerprint"]:
+        override_state["matcher"] = OverrideMatcher(overrides)
+        override_state["fingerprint"] = fingerprint
+        logger.info(f"✍️ Индекс ручных ответов пересобран: {len(overrides)}")
+
+
+async def _refresh_override_matcher_in_background():
+    try:
+        await refresh_override_matcher()
+    except Exception as e:
+        # Оставляем прежний индекс и пробуем снова через интервал
+        override_state["loaded_at"] = time.time()
+        logger.error(f"⚠️ Ошибка при обновлении overrides: {e}")
+
+
+async def check_override(question: str):
+    try:
+        # Загружаем синонимы, если они еще не загружены
+        if not synonyms_from_db:
+            await load_dynamic_data()
+
+        if override_state["matcher"] is None:
+            await refresh_override_matcher()
+        elif time.time() - override_state["loaded_at"] > OVERRIDES_REFRESH_INTERVAL:
+            task = override_state["task"]
+            if task is None or task.done():
+                override_state["task"] = asyncio.create_task(_refresh_override_matcher_in_background())
+
+        return override_state["matcher"].match(question)
 
     except Exception as e:
         logger.error(f"⚠️ Ошибка при запросе overrides: {e}")
@@ -695,10 +1292,84 @@ async def log_interaction(user_id: int, username: str, question: str, answer: st
         return "error"
 
 
-async def send_answer(update, context, answer, block, log_id, filename=None):
+class StreamPreview:
+    """Черновик ответа GPT в сообщении «Думаю...», правится не чаще STREAM_EDIT_INTERVAL"""
+
+    def __init__(self, message):
+        self.message = message
+        self.shown = False
+        self._last_edit = 0.0
+        self._last_text = THINKING_TEXT
+
+    @staticmethod
+    def preview_text(text):
+        """Текст черновика без служебной строки «ИСТОЧНИК: N», даже недописанной"""
+        lines = text.rstrip().split("\n")
+        tail = lines[-1].strip().upper()
+        if tail and ("ИСТОЧНИК".startswith(tail) or tail.startswith("ИСТОЧНИК")):
+            lines.pop()
+        preview = "\n".join(lines).strip()
+        if len(preview) < STREAM_MIN_CHARS or preview.lower().startswith("ответа нет"):
+            return None
+        if len(preview) > STREAM_PREVIEW_LIMIT:
+            preview = preview[:STREAM_PREVIEW_LIMIT] + "…"
+        return preview
+
+    async def update(self, text):
+        now = time.monotonic()
+        if now - self._last_edit < STREAM_EDIT_INTERVAL:
+            return
+        preview = self.preview_text(text)
+        if preview is None:
+            return
+        await self._edit(f"✍️ {preview} ▌")
+        self._last_edit = now
+        self.shown = True
+
+    async def reset(self):
+        """Черновик оказался не ответом — возвращаем «Думаю...»"""
+        if self.shown:
+            await self._edit(THINKING_TEXT)
+            self.shown = False
+
+    async def _edit(self, text):
+        if text == self._last_text:
+            return
+        try:
+            await self.message.edit_text(text)
+            self._last_text = text
+        except Exception as e:
+            # Ошибка правки (лимит, сообщение удалено) не должна ломать ответ
+            logger.warning(f"⚠️ Не удалось обновить черновик ответа: {e}")
+
+
+async def reply_in_place(update, message, text, reply_markup=None):
+    """Итоговый ответ: заменяет сообщение «Думаю...» (message), без него — новое сообщение.
+
+    Если заменить не удалось, отправляем новое, а «Думаю...» удаляем, чтобы не висело.
+    """
+    if message is not None:
+        try:
+            await message.edit_text(text, reply_markup=reply_markup)
+            return
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось заменить сообщение «Думаю...»: {e}")
+    await update.message.reply_text(text, reply_markup=reply_markup)
+    if message is not None:
+        try:
+            await message.delete()
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось удалить сообщение «Думаю...»: {e}")
+
+
+async def send_answer(update, context, answer, block, log_id, filename=None, message=None):
+    """Отправляет ответ; если задан message (сообщение «Думаю...»), первая часть заменяет его"""
     kb = [[InlineKeyboardButton("🚫 Пожаловаться", callback_data=f"complain:{log_id}")]]
     user_id = update.message.from_user.id
 
+    async def deliver_first(text, reply_markup=None):
+        await reply_in_place(update, message, text, reply_markup)
+
     # ДОБАВЛЕНО: Определение максимальной длины сообщения
     MAX_MESSAGE_LENGTH = 1000
 
@@ -739,7 +1410,7 @@ async def send_answer(update, context, answer, block, log_id, filename=None):
 
         # ДОБАВЛЕНО: Отправляем первую часть
         first_message = f"{source_info}✅ Ответ (1/{total_parts}):\n{messages[0]}"
-        await update.message.reply_text(first_message)
+        await deliver_first(first_message)
 
         # ДОБАВЛЕНО: Отправляем промежуточные части
         for i in range(1, total_parts - 1):
@@ -774,7 +1445,7 @@ async def send_answer(update, context, answer, block, log_id, filename=None):
             msg = f"{source_info}✅ Ответ:\n{answer}"
 
         # НЕИЗМЕНЕНО: Отправка сообщения с кнопкой жалобы
-        await update.message.reply_text(msg, reply_markup=InlineKeyboardMarkup(kb))
+        await deliver_first(msg, reply_markup=InlineKeyboardMarkup(kb))
 
     # ДОБАВЛЕНО: Логирование успешной отправки
     logger.info(f"✅ Ответ успешно отправлен пользователю {user_id}")
@@ -829,99 +1500,25 @@ def num_tokens(text):
     return len(encoding.encode(text))
 
 
-def split_into_blocks(text):
-    # print("🚀 Начинаем разбиение текста на блоки...")
-
-    # Ищем заголовки и разделы
-    section_patterns = [
-        r'\*\*([^*]+)\*\*',  # **Заголовок**
-        r'\n\d+\.\s',  # 1. Нумерованный список
-        r'\n•\s',  # • Маркированный список
-    ]
-
-    # Сначала попробуем разбить по заголовкам, сохраняя заголовки в блоках
-    sections = []
-    current_section = ""
-    lines = text.split('\n')
-
-    for line in lines:
-        if any(re.search(pattern, line) for pattern in section_patterns[:1]):  # Только заголовки
-            if current_section:
-                sections.append(current_section.strip())
-            current_section = line
-        else:
-            current_section += "\n" + line
-
-    if current_section:
-        sections.append(current_section.strip())
-
-    # Если получилось мало секций, используем более мелкое разбиение
-    if len(sections) < 3:
-        paragraphs = [p.strip() for p in re.split(r'\n\n|\n\d+\.\s|\n•\s', text) if len(p.strip()) > 0]
-
-        # Объединяем пронумерованные списки для сохранения контекста
-        blocks = []
-        current_block = ""
-        for p in paragraphs:
-            if re.match(r'\d+\.\s', p) or len(current_block) == 0:
-                if current_block:
-                    blocks.append(current_block.strip())
-                current_block = p
-            elif num_tokens(current_block + "\n\n" + p) < MAX_TOKENS_PER_BLOCK:
-                current_block += "\n\n" + p
-            else:
-                blocks.append(current_block.strip())
-                current_block = p
-
-        if current_block:
-            blocks.append(current_block.strip())
-
-        return blocks
-    else:
-        # Проверка размера блоков и разбиение слишком больших
-        blocks = []
-        for section in sections:
-            if num_tokens(section) > MAX_TOKENS_PER_BLOCK:
-                # Разбиваем большую секцию
-                sub_parts = [p.strip() for p in re.split(r'\n\n|\n\d+\.\s', section) if len(p.strip()) > 0]
-                current_sub = ""
-                for part in sub_parts:
-                    if num_tokens(current_sub + "\n\n" + part) < MAX_TOKENS_PER_BLOCK:
-                        current_sub += "\n\n" + part
-                    else:
-                        blocks.append(current_sub.strip())
-                        current_sub = part
-                if current_sub:
-                    blocks.append(current_sub.strip())
-            else:
-                blocks.append(section)
-
-        return blocks
-
-
-def extract_keywords_from_question(question, synonyms_from_db):
+def extract_keywords_from_question(words):
+    """Синонимы всех групп, куда входят слова вопроса (с учётом начальной формы)"""
     result = set()
-    for word in question.lower().split():
-        for key, values in synonyms_from_db.items():
-            if word == key or word in values:
-                result.update(values)
+    for word in words:
+        for key in synonym_groups(word, use_lemma=True):
+            result.update(synonym_index["groups"][key])
     return result
 
 
-def is_relevant_block(block, question, synonyms_from_db):
-    keywords = extract_keywords_from_question(question, synonyms_from_db)
-    return any(k in block.lower() for k in keywords)
+def is_relevant_block(block_norm, keywords):
+    return any(k in block_norm for k in keywords)
 
 
-async def ask_gpt(block, question, username):
+async def ask_gpt(block, query, username, on_text=None):
     """Асинхронная версия запроса к GPT с повторными попытками"""
     tone = get_tone_by_username(username)
+    question = query.text
 
-    # Определяем, связан ли вопрос с инструкцией
-    instruction_keywords = ["как", "инструкция", "шаги", "порядок действий", "процедура", "механизм", "алгоритм"]
-    is_instruction_question = any(keyword in question.lower() for keyword in instruction_keywords)
-
-    if is_instruction_question:
+    if query.is_instruction:
         prompt = f"""
             {tone}
 
@@ -960,11 +1557,8 @@ async def ask_gpt(block, question, username):
         # Используем семафор для ограничения параллельных запросов к API
         async with api_semaphore:
             async def _call_gpt():
-                llm = ChatOpenAI(model_name="gpt-3.5-turbo", temperature=0.2, max_tokens=1000, max_retries=3)
                 #logger.info("📡 Отправка запроса к GPT...")
-                response = await llm.ainvoke(prompt)
-                #logger.info("📥 Получен ответ от GPT")
-                return response.content.strip()
+                return await complete(prompt, "answer", on_text=on_text)
 
             # Запускаем с повторными попытками
             return await retry_async(_call_gpt)
@@ -972,30 +1566,293 @@ async def ask_gpt(block, question, username):
         logger.error(f"⚠️ Ошибка при запросе к GPT: {e}")
         return "ответа нет"
 
+
+SOURCE_LINE_RE = re.compile(r"[ \t]*ИСТОЧНИК\s*:\s*\[?\s*(?:блок\s*)?(\d+)\s*\]?\.?[ \t]*$", re.IGNORECASE | re.MULTILINE)
+
+
+def pack_blocks(candidates, budget=ANSWER_BLOCKS_TOKEN_BUDGET):
+    """Берёт блоки [(block, filename, tokens)] по порядку, пока они помещаются в бюджет токенов.
+
+    tokens посчитаны заранее (при индексации и в assemble_context) — блоки не токенизируем заново.
+    """
+    packed, used = [], 0
+    for block, filename, tokens in candidates:
+        if packed and used + tokens > budget:
+            break
+        packed.append((block, filename))
+        used += tokens
+    return packed
+
+
+def split_citation(answer, count):
+    """Отделяет строку «ИСТОЧНИК: N» от ответа, возвращает (текст, индекс блока или None)"""
+    matches = list(SOURCE_LINE_RE.finditer(answer))
+    if not matches:
+        return answer.strip(), None
+    number = int(matches[-1].group(1))
+    text = SOURCE_LINE_RE.sub("", answer).strip()
+    return text, number - 1 if 1 <= number <= count else None
+
+
+async def ask_gpt_combined(candidates, query, username, on_text=None, template="combined"):
+    """Один запрос к GPT по нескольким блокам; возвращает (answer, block, filename) или None.
+
+    template — "combined" для найденных поиском блоков, "priority" — для приоритетных документов.
+    """
+    packed = pack_blocks(candidates)
+    if not packed:
+        return None
+    blocks_text = "\n\n".join(
+        f"[Блок {i}] ({filename})\n{block}" for i, (block, filename) in enumerate(packed, 1)
+    )
+    if template == "priority":
+        prompt = priority_prompt(blocks_text, query)
+    else:
+        prompt = combined_prompt(blocks_text, query, username)
+
+    profile = "priority" if template == "priority" else "answer"
+
+    try:
+        async with api_semaphore:
+            async def _call_gpt():
+                return await complete(prompt, template, profile=profile, on_text=on_text)
+
+            raw = await retry_async(_call_gpt)
+    except Exception as e:
+        logger.error(f"⚠️ Ошибка при запросе к GPT: {e}")
+        return None
+
+    answer, index = split_citation(raw, len(packed))
+    if not is_useful_answer(answer):
+        return None
+    if index is None:
+        logger.warning("⚠️ GPT не указал источник, считаем источником первый блок")
+        index = 0
+    block, filename = packed[index]
+    logger.info(f"✅ Ответ по {len(packed)} блокам, источник — блок {index + 1} ({filename}): {answer[:50]}...")
+    return answer, block, filename
+
+
+def priority_prompt(blocks_text, query):
+    """Специальный промпт для приоритетных документов"""
+    return f"""
+            Ты ищешь ответ в корпоративном документе компании.
+
+            ВНИМАТЕЛЬНО прочитай пронумерованные блоки документа и найди информацию о скидках, льготах, поощрениях для сотрудников.
+
+            Если найдешь ответ - дай ПОЛНЫЙ и ТОЧНЫЙ ответ со всеми деталями и процентами.
+            Последней строкой ответа напиши номер блока, на котором основан ответ, в виде: ИСТОЧНИК: <номер>
+            Если информации нет - напиши "ответа нет".
+
+            {blocks_text}
+
+            Вопрос: {query.text}
+
+            Ответ:
+            """
+
+
+def combined_prompt(blocks_text, query, username):
+    tone = get_tone_by_username(username)
+    if query.is_instruction:
+        rules = """Ты эксперт по CRM системе Автодилер и внутренним инструкциям.
+            Если в блоке есть пронумерованный список или шаги инструкции - ОБЯЗАТЕЛЬНО сохрани все пункты с их оригинальной нумерацией.
+            Не обобщай и не сокращай шаги. Если в вопросе упоминается конкретная роль, найди соответствующий раздел."""
+    else:
+        rules = "Если в тексте есть списки или шаги - приведи их полностью."
+
+    return f"""
+            {tone}
+
+            Ответь на вопрос, используя ТОЛЬКО информацию из пронумерованных блоков ниже.
+            {rules}
+            Не добавляй информацию, которой нет в блоках.
+            Последней строкой ответа напиши номер блока, на котором основан ответ, в виде: ИСТОЧНИК: <номер>
+            Если ни в одном блоке нет ответа — напиши только: "ответа нет".
+
+            {blocks_text}
+
+            Вопрос: {query.text}
+            Ответ:
+            """
+
+
+def is_useful_answer(answer):
+    return "ответа нет" not in answer.lower() and len(answer.strip()) > 10
+
+
+async def collect_answers(candidates, query, username, limit=MAX_ANSWERS):
+    """Проверяет блоки [(block, filename, tokens)] через GPT, возвращает до limit годных ответов в порядке блоков"""
+    if not ASK_GPT_PARALLEL:
+        answers = []
+        for block, filename, _ in candidates:
+            answer = await ask_gpt(block, query, username)
+            if is_useful_answer(answer):
+                answers.append((answer, block, filename))
+                logger.info(f"✅ Найден ответ в {filename}: {answer[:50]}...")
+                if len(answers) >= limit:
+                    break
+        return answers
+
+    async def _ask(index, block, filename):
+        return index, block, filename, await ask_gpt(block, query, username)
+
+    # Все запросы стартуют сразу, одновременно к API идут не больше MAX_CONCURRENT_REQUESTS
+    tasks = [asyncio.create_task(_ask(i, block, filename)) for i, (block, filename, _) in enumerate(candidates)]
+    found = []
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            index, block, filename, answer = await next_done
+            if is_useful_answer(answer):
+                found.append((index, (answer, block, filename)))
+                logger.info(f"✅ Найден ответ в {filename}: {answer[:50]}...")
+                if len(found) >= limit:
+                    break
+    finally:
+        # Хватит ответов (или вопрос отменён) — оставшиеся запросы не нужны
+        pending = [task for task in tasks if not task.done()]
+        for task in pending:
+            task.cancel()
+        if pending:
+            logger.info(f"🛑 Отменено лишних запросов к GPT: {len(pending)}")
+            await asyncio.gather(*pending, return_exceptions=True)
+    # Порядок ответов — как у блоков, первый остаётся ответом по умолчанию
+    return [answer for _, answer in sorted(found, key=lambda item: item[0])]
+
 def get_tone_by_username(username: str) -> str:
     if username in {"msattarov", "Madi Sattarov	"}:  # можно любые username
         return "Отвечай грубо, дерзко, с переходами на личности. Можешь использовать сарказм, пренебрежение, высокомерие и унижение."
     return "Ты помощник по регламентам. Говори вежливо, по делу, остроумно и добавь комплимент."
 
 
-def is_relevant_for_role(block, question):
-    """Определяет, соответствует ли блок роли, упомянутой в вопросе"""
-    role_keywords = {
-        "администратор": ["администратор", "атз", "ресепшионист", "ресепшн"],
-        "менеджер": ["менеджер", "продавец", "менеджер отдела продаж", "мене", "мсп"],
-        "руководитель": ["руководитель", "роп", "руководитель отдела", "директор"]
-    }
+ROLE_KEYWORDS = {
+    "администратор": ["администратор", "атз", "ресепшионист", "ресепшн"],
+    "менеджер": ["менеджер", "продавец", "менеджер отдела продаж", "мене", "мсп"],
+    "руководитель": ["руководитель", "роп", "руководитель отдела", "директор"]
+}
 
-    question_lower = question.lower()
 
-    # Проверяем, упоминается ли роль в вопросе
-    for role, keywords in role_keywords.items():
-        if any(keyword in question_lower for keyword in keywords):
-            # Проверяем наличие заголовка с ролью в блоке
-            role_pattern = fr'\*\*\s*{role}.*?\*\*|\*\*.*?{role}.*?\*\*'
-            return bool(re.search(role_pattern, block, re.IGNORECASE))
+INSTRUCTION_KEYWORDS = ["как", "инструкция", "шаги", "порядок действий", "процедура", "механизм", "алгоритм"]
 
-    return False
+
+class KeywordMatcher:
+    """Автомат Ахо-Корасик: все вхождения ключевых слов в текст за один проход.
+
+    keywords — ключевое слово -> категории. match возвращает категория ->
+    найденные ключевые слова в порядке первого вхождения.
+    """
+
+    def __init__(self, keywords: Dict[str, Set[str]]):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        for keyword, categories in keywords.items():
+            if not keyword:
+                continue
+            state = 0
+            for char in keyword:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.output[state].extend((keyword, category) for category in categories)
+
+        # Ссылки неудач — обходом в ширину
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for char, child in self.goto[state].items():
+                queue.append(child)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    def match(self, text: str) -> Dict[str, List[str]]:
+        found = {}
+        state = 0
+        for char in text:
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            for keyword, category in self.output[state]:
+                keywords = found.setdefault(category, [])
+                if keyword not in keywords:
+                    keywords.append(keyword)
+        return found
+
+
+def refresh_keyword_matcher() -> None:
+    """Пересобирает автомат ключевых слов, если изменились приоритеты"""
+    global keyword_matcher, _keyword_matcher_source
+    source = frozenset(priorities_from_db)
+    if keyword_matcher is not None and source == _keyword_matcher_source:
+        return
+    keywords = defaultdict(set)
+    for keyword in priorities_from_db:
+        keywords[keyword].add("priority")
+    for keyword in CRM_KEYWORDS:
+        keywords[keyword].add("crm")
+    for keyword in INSTRUCTION_KEYWORDS:
+        keywords[keyword].add("instruction")
+    for role, role_keywords in ROLE_KEYWORDS.items():
+        for keyword in role_keywords:
+            keywords[keyword].add(f"role:{role}")
+    keyword_matcher = KeywordMatcher(keywords)
+    _keyword_matcher_source = source
+    logger.info(f"🔤 Автомат ключевых слов собран: {len(keywords)} слов")
+
+
+def match_keywords(text: str) -> Dict[str, List[str]]:
+    """Категории и ключевые слова, найденные в тексте (без учёта регистра)"""
+    if keyword_matcher is None:
+        refresh_keyword_matcher()
+    return keyword_matcher.match(text.lower())
+
+
+SEARCH_STOP_WORDS = {"и", "а", "в", "на", "по", "к", "с", "от", "из", "у", "о", "за", "для", "как", "что"}
+IMPORTANT_SHORT_WORDS = {"срм", "crm", "атз"}
+
+
+@dataclass(frozen=True)
+class QueryContext:
+    """Разбор вопроса, общий для всех этапов поиска; строится один раз на вопрос"""
+    text: str
+    lower: str
+    words: List[str]  # слова через split, как их видят старые проверки
+    lemmas: Set[str]  # начальные формы всех слов
+    search_lemmas: Set[str]  # леммы значимых слов для поиска по чанкам
+    keywords: Dict[str, List[str]]  # категория -> найденные ключевые слова
+    role: Optional[str]
+    is_instruction: bool
+    synonym_keywords: Set[str]
+
+
+def build_query_context(question: str) -> QueryContext:
+    lower = question.lower()
+    words = lower.split()
+    search_words = [w for w in re.findall(r'\b\w{4,}\b', lower) if w not in SEARCH_STOP_WORDS]
+    search_words += [w for w in words if w in IMPORTANT_SHORT_WORDS]
+    keywords = match_keywords(lower)
+    return QueryContext(
+        text=question,
+        lower=lower,
+        words=words,
+        lemmas=set(normalize(lower)),
+        search_lemmas={normal_form(w) for w in search_words},
+        keywords=keywords,
+        # Роль, упомянутая в вопросе (первая по порядку ROLE_KEYWORDS)
+        role=next((role for role in ROLE_KEYWORDS if f"role:{role}" in keywords), None),
+        is_instruction="instruction" in keywords,
+        synonym_keywords=extract_keywords_from_question(words),
+    )
+
+
+def is_relevant_for_role(chunk: Dict[str, Any], role_chunk_ids: Set[int]) -> bool:
+    """Есть ли в чанке заголовок с ролью из вопроса (заголовки найдены при индексации)"""
+    return chunk["id"] in role_chunk_ids
 
 async def gpt_choose_best(question, answers):
     """Асинхронная версия выбора лучшего ответа"""
@@ -1009,9 +1866,7 @@ async def gpt_choose_best(question, answers):
 """
     try:
         async def _call_gpt():
-            llm = ChatOpenAI(model_name="gpt-3.5-turbo", temperature=0.2, max_tokens=1000, max_retries=3)
-            response = await llm.ainvoke(prompt)
-            return response.content.strip()
+            return await complete(prompt, "choose_best")
 
         return await retry_async(_call_gpt)
     except Exception as e:
@@ -1019,25 +1874,19 @@ async def gpt_choose_best(question, answers):
         # В случае ошибки возвращаем первый ответ
         return answers[0] if answers else "Ответ не найден"
 
-def contains_instructions(block):
-    """Проверяет, содержит ли блок инструкции или пронумерованные шаги"""
-    # Ищем нумерованные списки или пункты
-    pattern = r'\d+\.\s|\d+\)\s|•\s'
-    return bool(re.search(pattern, block))
+def contains_instructions(chunk: Dict[str, Any]) -> bool:
+    """Содержит ли чанк инструкции или пронумерованные шаги (признак из индексации)"""
+    return chunk["has_steps"]
 
 
-async def process_question(update: Update, context, question, user_id, username):
+async def process_question(update: Update, context, question, user_id, username, thinking=None):
     """Основная логика обработки вопроса"""
     logger.info(f"🔍 Обрабатываем вопрос: '{question}'")
 
-    # 🔄 1) Загрузка документов и данных
-    global docs
-    await load_dynamic_data()
-    docs = await cached(lambda: asyncio.to_thread(load_docs))
-    logger.info(f"📂 Загружено документов: {len(docs)}")
-
-    # 🔄 Приводим все загруженные файлы к нормализованной форме
-    docs = [(unicodedata.normalize('NFKD', name).lower().strip(), content) for name, content in docs]
+    # 🔄 1) Текущий снимок корпуса — берём ссылку один раз на весь вопрос
+    snapshot = corpus
+    docs = snapshot.chunks
+    logger.info(f"📂 Корпус версии {snapshot.version}: {len(docs)} чанков")
 
     # 🔍 3) Ручной override
     override = await check_override(question)
@@ -1045,22 +1894,26 @@ async def process_question(update: Update, context, question, user_id, username)
         log_id = await log_interaction(user_id, username, question, override)
         if log_id and log_id != "error":
             kb = [[InlineKeyboardButton("🚫 Пожаловаться", callback_data=f"complain:{log_id}")]]
-            await update.message.reply_text(
-                text=f"✅ Ручной ответ:\n{override}",
-                reply_markup=InlineKeyboardMarkup(kb)
+            await reply_in_place(
+                update, thinking, f"✅ Ручной ответ:\n{override}", reply_markup=InlineKeyboardMarkup(kb)
             )
         else:
-            await update.message.reply_text(
-                text=f"✅ Ручной ответ:\n{override}\n\n⚠️ (жалоба на ответ недоступна)"
+            await reply_in_place(
+                update, thinking, f"✅ Ручной ответ:\n{override}\n\n⚠️ (жалоба на ответ недоступна)"
             )
         return
 
+    # Разбор вопроса — один раз для всех этапов
+    query = build_query_context(question)
+    # ✍️ Ответ единственного запроса к GPT стримим в сообщение «Думаю...»
+    preview = StreamPreview(thinking) if thinking is not None else None
+
     # 🎯 ИСПРАВЛЕННАЯ проверка приоритетных документов
     priority_hits = []
-    question_lower = question.lower()
 
-    for keyword, prio_doc in priorities_from_db.items():
-        if keyword in question_lower:
+    for keyword in query.keywords.get("priority", []):
+        prio_doc = priorities_from_db.get(keyword)
+        if prio_doc:
             if isinstance(prio_doc, str):
                 normalized_doc = unicodedata.normalize('NFKD', prio_doc).lower().strip()
                 priority_hits.append(normalized_doc)
@@ -1072,95 +1925,65 @@ async def process_question(update: Update, context, question, user_id, username)
 
     # 🎯 НОВАЯ ЛОГИКА: Тщательный поиск в приоритетных документах
     if priority_hits:
+        # Ключевые слова из вопроса для проверки кусков
+        question_words = [w for w in query.words if len(w) > 2]
         logger.info(f"🎯 Найдены приоритетные документы: {priority_hits}")
-        priority_docs = [(name, content) for (name, content) in docs if name in priority_hits]
+        priority_docs = chunks_for_documents(snapshot.by_doc, priority_hits)
 
+        # Кандидаты — чанки со словами вопроса; лучшие отбирает cross-encoder,
+        # и все они уходят в GPT одним запросом
+        priority_docs = [chunk for chunk in priority_docs if any(word in chunk["text_norm"] for word in question_words)]
         if priority_docs:
-            logger.info(f"🎯 Запуск тщательного поиска в {len(priority_docs)} приоритетных документах")
-
-            # Тщательный поиск в приоритетных документах
-            for filename, content in priority_docs:
-                logger.info(f"🔍 Детальный поиск в: {filename}")
-
-                # Ищем по крупным кускам (4000 символов)
-                step = 4000
-                for i in range(0, len(content), step):
-                    part = content[i:i + step]
-
-                    # Проверяем, есть ли в этом куске ключевые слова из вопроса
-                    question_words = [w for w in question.lower().split() if len(w) > 2]
-                    if any(word in part.lower() for word in question_words):
-
-                        # Специальный промпт для приоритетных документов
-                        prompt = f"""
-                        Ты ищешь ответ в корпоративном документе компании.
-
-                        ВНИМАТЕЛЬНО прочитай текст и найди информацию о скидках, льготах, поощрениях для сотрудников.
-
-                        Если найдешь ответ - дай ПОЛНЫЙ и ТОЧНЫЙ ответ со всеми деталями и процентами.
-                        Если информации нет - напиши "ответа нет".
-
-                        Текст документа:
-                        {part}
-
-                        Вопрос: {question}
-
-                        Ответ:
-                        """
-
-                        try:
-                            async with api_semaphore:
-                                llm = ChatOpenAI(model_name="gpt-3.5-turbo", temperature=0.1, max_tokens=1000)
-                                response = await llm.ainvoke(prompt)
-                                answer = response.content.strip()
-
-                            if "ответа нет" not in answer.lower() and len(answer.strip()) > 10:
-                                logger.info(f"✅ НАЙДЕН ОТВЕТ в приоритетном документе!")
-                                log_id = await log_interaction(user_id, username, question, answer)
-                                await send_answer(update, context, answer, part, log_id, filename=filename)
-                                return
+            logger.info(f"🎯 Поиск в приоритетных документах: {len(priority_docs)} чанков со словами вопроса")
+            scored = await asyncio.to_thread(rerank, question, priority_docs[:RERANK_CANDIDATES])
+            if scored is not None:
+                priority_docs = [chunk for score, chunk in scored[:RERANK_TOP_N] if score >= RERANK_THRESHOLD]
+            # Чанк приоритетного документа уже ограничен по токенам при индексации
+            found = await ask_gpt_combined(
+                [(chunk["chunk"], chunk["name"], chunk["token_count"]) for chunk in priority_docs],
+                query, username, on_text=preview.update if preview else None, template="priority"
+            )
+            if found:
+                answer, part, filename = found
+                logger.info(f"✅ НАЙДЕН ОТВЕТ в приоритетном документе!")
+                log_id = await log_interaction(user_id, username, question, answer)
+                await send_answer(update, context, answer, part, log_id, filename=filename, message=thinking)
+                return
+            if preview:
+                await preview.reset()
+
+    # Число совпавших лемм вопроса у каждого чанка (по инвертированному индексу)
+    lemma_hits = Counter()
+    for lemma in query.search_lemmas:
+        lemma_hits.update(snapshot.by_lemma.get(lemma, ()))
+
+    # 🔎 Ранжированный поиск: BM25 по леммам (FTS) и семантический по FAISS, ранги сливаем
+    from parse_documents import search_chunks
+    fts_hits, vector_hits = await asyncio.gather(
+        asyncio.to_thread(search_chunks, question),
+        asyncio.to_thread(vector_search, question, snapshot)
+    )
+    search_rank = fuse_rankings(
+        [chunk_id for chunk_id, _ in fts_hits or []],
+        [chunk_id for chunk_id, _ in vector_hits or []]
+    )
 
-                        except Exception as e:
-                            logger.error(f"Ошибка GPT: {e}")
-                            continue
+    def relevance(chunk):
+        return search_rank.get(chunk["id"], len(search_rank))
 
     # 🔍 Проверяем, есть ли в вопросе ключевые слова из CRM
-    if any(keyword in question.lower() for keyword in CRM_KEYWORDS):
+    by_doc = snapshot.by_doc
+    if "crm" in query.keywords:
         logger.info("🔎 Ключевое слово CRM найдено. Ищем только в 3 документах.")
 
-        # Фильтруем только нужные файлы
-        ordered_docs = [(name, content) for (name, content) in docs if name in CRM_DOCUMENTS]
-
-        # Принудительная сортировка, чтобы менеджер был первым
-        ordered_docs.sort(key=lambda x: (
-            'менеджер отдела продаж' in x[0].lower(),
-            'роп' in x[0].lower(),
-            'администратор' in x[0].lower()
-        ), reverse=True)
-
-        if not ordered_docs:
-            logger.error(f"❌ Документы CRM не найдены в базе: {CRM_DOCUMENTS}")
-    else:
-        # 🔄 Упорядочиваем документы по приоритету
-        if priority_hits:
-            logger.info(f"📌 Приоритетные документы по ключевым словам: {priority_hits}")
-            priority_docs = [(name, content) for (name, content) in docs if name in priority_hits]
-            other_docs = [(name, content) for (name, content) in docs if name not in priority_hits]
-            ordered_docs = priority_docs + other_docs
-        else:
-            ordered_docs = docs.copy()
-
-    # 🔍 Фильтрация документов по роли (только для CRM)
-    if any(keyword in question.lower() for keyword in CRM_KEYWORDS):
-        priority_order = []
-
-        if "менеджер" in question.lower():
+        # Порядок документов по роли из вопроса
+        if "менеджер" in query.lower:
             priority_order = [
                 "porsche инструкция по работе системой автодилер менеджер отдела продаж.docx",
                 "porsche инструкция по работе системой автодилер роп.docx",
                 "porsche инструкция по работе системой автодилер администратор.docx"
             ]
-        elif "роп" in question.lower() or "руководитель" in question.lower():
+        elif "роп" in query.lower or "руководитель" in query.lower:
             priority_order = [
                 "porsche инструкция по работе системой автодилер роп.docx",
                 "porsche инструкция по работе системой автодилер менеджер отдела продаж.docx",
@@ -1173,71 +1996,111 @@ async def process_question(update: Update, context, question, user_id, username)
                 "porsche инструкция по работе системой автодилер менеджер отдела продаж.docx"
             ]
 
-        # 🔄 Перекладываем в нужном порядке
-        ordered_docs = sorted(
-            ordered_docs,
-            key=lambda x: priority_order.index(x[0]) if x[0] in priority_order else 100
-        )
+        # 🔄 Чанки документов CRM по релевантности, роль из вопроса — только при равенстве
+        ordered_docs = chunks_for_documents(by_doc, map(normalize_doc_name, priority_order), key=relevance)
+
+        if not ordered_docs:
+            logger.error(f"❌ Документы CRM не найдены в базе: {CRM_DOCUMENTS}")
+    else:
+        # 🗂 Грубый отбор: несколько документов по профилям, дальше ищем только среди их чанков
+        shortlist = rank_documents(query.lemmas, snapshot.profiles, snapshot.idf)
+        candidate_docs = []
+        if shortlist:
+            logger.info(f"🗂 Документы-кандидаты по профилям: {shortlist}")
+            # Чанки отобранных документов, найденные поиском или со словами вопроса:
+            # выше — по слиянию рангов поиска, затем по числу совпавших лемм
+            candidate_docs = [
+                chunk for chunk in chunks_for_documents(by_doc, shortlist)
+                if chunk["id"] in search_rank or lemma_hits[chunk["id"]]
+            ]
+            candidate_docs.sort(key=lambda c: (relevance(c), -lemma_hits[c["id"]]))
+        if not candidate_docs:
+            if search_rank:
+                # Профили ничего не дали — кандидаты из топа поиска по всему корпусу
+                candidate_docs = [
+                    snapshot.by_id[i] for i in search_rank
+                    if i in snapshot.by_id and snapshot.by_id[i]["duplicate_of"] is None
+                ]
+            else:
+                # Совпадений нет — как раньше, первые чанки корпуса
+                candidate_docs = docs[:RERANK_CANDIDATES]
+
+        # 🔄 Упорядочиваем документы по приоритету
+        if priority_hits:
+            logger.info(f"📌 Приоритетные документы по ключевым словам: {priority_hits}")
+            priority_docs = sorted(chunks_for_documents(by_doc, priority_hits), key=relevance)
+            priority_ids = {chunk["id"] for chunk in priority_docs}
+            other_docs = [chunk for chunk in candidate_docs if chunk["id"] not in priority_ids]
+            # Приоритет лишь разрешает равенство релевантности: иначе большой документ
+            # занял бы все места перед rerank и найденные поиском чанки до него не дошли бы
+            ordered_docs = sorted(
+                priority_docs + other_docs, key=lambda c: (relevance(c), c["id"] not in priority_ids)
+            )
+        else:
+            ordered_docs = list(candidate_docs)
+
+    # 🎯 Переранжирование cross-encoder'ом: в GPT уходят только лучшие блоки
+    reranked = await asyncio.to_thread(rerank, question, ordered_docs[:RERANK_CANDIDATES])
+    if reranked is not None:
+        logger.info(f"🎯 Rerank: {[(round(score, 3), chunk['name']) for score, chunk in reranked[:RERANK_TOP_N]]}")
+        ordered_docs = [chunk for score, chunk in reranked[:RERANK_TOP_N] if score >= RERANK_THRESHOLD]
+        if not ordered_docs:
+            # Ни один блок не похож на ответ — не тратим вызовы GPT
+            await send_not_found(update, user_id, username, question, thinking)
+            return
 
     # 🔄 4) Прямой поиск по ключевым словам из вопроса
-    answers = []
+    # Роль из вопроса определяем один раз, чанки с её заголовком берём из индекса
+    role_chunk_ids = snapshot.by_role.get(query.role, set())
 
-    def direct_search_relevant(block, question):
+    def direct_search_relevant(chunk):
         # Проверка по роли
-        if is_relevant_for_role(block, question):
+        if is_relevant_for_role(chunk, role_chunk_ids):
             return True
-        important_short_words = ["срм", "crm", "атз"]
-        stop_words = {"и", "а", "в", "на", "по", "к", "с", "от", "из", "у", "о", "за", "для", "как", "что"}
-        words = [w for w in re.findall(r'\b\w{4,}\b', question.lower()) if w not in stop_words]
-        words += [w for w in question.lower().split() if w in important_short_words]
-        return any(w in block.lower() for w in words)
+        return lemma_hits[chunk["id"]] > 0
+
+    def candidate_blocks(accept):
+        """Блоки для GPT из лучших чанков; чанк, уже попавший в окно соседа, пропускаем"""
+        blocks, covered = [], set()  # covered — id чанков, уже вошедших в окно контекста
+        for chunk in ordered_docs[:SEARCH_TOP_K]:  # Ограничиваем количество документов
+            if chunk["id"] in covered or not accept(chunk):
+                continue
+            block, window_ids, tokens = assemble_context(chunk, snapshot.by_id)
+            covered |= window_ids
+            blocks.append((block, chunk["name"], tokens))
+        return blocks
+
+    async def find_answers(candidates):
+        if ANSWER_MODE == "combined":
+            found = await ask_gpt_combined(
+                candidates, query, username, on_text=preview.update if preview else None
+            )
+            if not found and preview:
+                await preview.reset()
+            return [found] if found else []
+        return await collect_answers(candidates, query, username)
 
     # 🔍 Поиск по документам
-    for filename, text in ordered_docs[:10]:  # Ограничиваем количество документов
-        blocks = split_into_blocks(text)
-
-        for block in blocks[:5]:  # Ограничиваем количество блоков
-            if direct_search_relevant(block, question):
-                answer = await ask_gpt(block, question, username)
-                if "ответа нет" not in answer.lower() and len(answer.strip()) > 10:
-                    answers.append((answer, block, filename))
-                    logger.info(f"✅ Найден ответ в {filename}: {answer[:50]}...")
-                    if len(answers) >= 3:  # Максимум 3 ответа
-                        break
-
-        if len(answers) >= 3:
-            break
+    # Каждый чанк уже является готовым блоком (разбит по токенам при индексации)
+    # После переранжирования блоки уже отобраны по релевантности
+    answers = await find_answers(
+        candidate_blocks(lambda chunk: reranked is not None or direct_search_relevant(chunk))
+    )
 
     # 🔄 5) Если ищем инструкцию, даем приоритет блокам с инструкциями
-    if not answers:
-        question_lower = question.lower()
-        if "как" in question_lower or "инструкция" in question_lower:
-            for filename, text in ordered_docs[:10]:
-                blocks = split_into_blocks(text)
-                for block in blocks[:5]:
-                    if direct_search_relevant(block, question) and contains_instructions(block):
-                        answer = await ask_gpt(block, question, username)
-                        if "ответа нет" not in answer.lower() and len(answer.strip()) > 10:
-                            answers.append((answer, block, filename))
-                            if len(answers) >= 3:
-                                break
-                if len(answers) >= 3:
-                    break
+    # (после переранжирования лучшие блоки уже проверены — повторные проходы не нужны)
+    if not answers and reranked is None:
+        if "как" in query.lower or "инструкция" in query.lower:
+            answers = await find_answers(
+                candidate_blocks(lambda chunk: direct_search_relevant(chunk) and contains_instructions(chunk))
+            )
 
     # 🔄 6) Второй проход — поиск с синонимами
-    if not answers:
+    if not answers and reranked is None:
         logger.info("🔄 Ничего не найдено в прямом поиске, пробуем с синонимами...")
-        for filename, text in ordered_docs[:10]:
-            blocks = split_into_blocks(text)
-            for block in blocks[:5]:
-                if is_relevant_block(block, question, synonyms_from_db):
-                    answer = await ask_gpt(block, question, username)
-                    if "ответа нет" not in answer.lower() and len(answer.strip()) > 10:
-                        answers.append((answer, block, filename))
-                        if len(answers) >= 3:
-                            break
-            if len(answers) >= 3:
-                break
+        answers = await find_answers(
+            candidate_blocks(lambda chunk: is_relevant_block(chunk["text_norm"], query.synonym_keywords))
+        )
 
     # 🔎 7) Выбор лучшего ответа
     if answers:
@@ -1253,16 +2116,17 @@ async def process_question(update: Update, context, question, user_id, username)
                     break
 
         log_id = await log_interaction(user_id, username, question, best_answer)
-        await send_answer(update, context, best_answer, best_block, log_id, filename=best_filename)
+        await send_answer(update, context, best_answer, best_block, log_id, filename=best_filename, message=thinking)
         return
 
     # Если ничего не найдено
+    await send_not_found(update, user_id, username, question, thinking)
+
+
+async def send_not_found(update: Update, user_id, username, question, message=None):
     log_id = await log_interaction(user_id, username, question, "Ничего не найдено")
     kb = [[InlineKeyboardButton("🚫 Пожаловаться", callback_data=f"complain:{log_id}")]]
-    await update.message.reply_text(
-        "❌ Ничего не найдено.",
-        reply_markup=InlineKeyboardMarkup(kb)
-    )
+    await reply_in_place(update, message, "❌ Ничего не найдено.", reply_markup=InlineKeyboardMarkup(kb))
 
 
 def is_law_related_question(text: str) -> bool:
@@ -1443,11 +2307,11 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Первичный ответ пользователю
     logger.info(f"🔍 Отправка первичного ответа пользователю {user_id}")
-    await update.message.reply_text("⏳ Думаю...")
+    thinking = await update.message.reply_text(THINKING_TEXT)
 
-    # Добавляем задачу в очередь
+    # Добавляем задачу в очередь; в сообщение «Думаю...» потом стримится ответ
     logger.info(f"🔍 Добавление задачи в очередь для {user_id}: {question}")
-    await processing_queue.put((update, context, question, user_id, username))
+    await processing_queue.put((update, context, question, user_id, username, thinking))
     logger.info(f"✅ Задача добавлена в очередь, размер очереди: {processing_queue.qsize()}")
 
 
@@ -1510,6 +2374,19 @@ async def on_startup(app):
     logger.info(f"✅ Запущено {len(worker_tasks)} обработчиков очереди")
     logger.info("🔍 Загрузка приоритетов и синонимов...")
     await load_dynamic_data()
+    app._config_task = asyncio.create_task(refresh_config_periodically())
+    logger.info("🔍 Загрузка документов...")
+    await asyncio.to_thread(refresh_corpus)
+    app._corpus_task = asyncio.create_task(watch_corpus_version())
+    logger.info("🔍 Загрузка векторного индекса...")
+    await asyncio.to_thread(refresh_vector_index)
+    if vector_index["index"] is not None:
+        await asyncio.to_thread(get_embedding_model)
+    logger.info("🔍 Загрузка модели переранжирования...")
+    await asyncio.to_thread(get_reranker)
+    logger.info(f"🔍 Подготовка клиентов LLM (HTTP/2: {'да' if LLM_HTTP2 else 'нет'})...")
+    for profile in LLM_MODELS:
+        get_llm(profile)
     # Загружаем пользователей
     logger.info("🔍 Загрузка списка разрешенных пользователей...")
     for attempt in range(10):
@@ -1527,7 +2404,7 @@ async def on_startup(app):
 if __name__ == "__main__":
     from threading import Thread
 
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).post_init(on_startup).build()
+    app = ApplicationBuilder().token(TELEGRAM_TOKEN).post_init(on_startup).post_shutdown(close_llm_clients).build()
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     app.add_handler(CommandHandler("stats", show_stats))
     app.add_handler(CommandHandler("adduser", add_user))
@@ -1,17 +1,111 @@
+import os
+import json
+from array import array
 from langchain.vectorstores import FAISS
 from langchain_community.embeddings import HuggingFaceEmbeddings
 import parse_documents
+from parse_documents import EMBEDDING_MODEL, FAISS_INDEX_PATH, CHUNK_IDS_FILE
+
+EMBED_BATCH_SIZE = 256  # сколько новых чанков кодируем и записываем за раз
+
+
+def init_embeddings_table(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS embeddings (
+        content_hash TEXT NOT NULL,
+        model TEXT NOT NULL,
+        dim INTEGER NOT NULL,
+        vector BLOB NOT NULL,
+        PRIMARY KEY (content_hash, model)
+    )
+    """)
+    conn.commit()
+
+
+def load_cached_vectors(conn, hashes, model=EMBEDDING_MODEL):
+    """hash -> вектор (array('f')) для уже посчитанных эмбеддингов"""
+    vectors = {}
+    hashes = list(hashes)
+    for start in range(0, len(hashes), parse_documents.WRITE_BATCH_SIZE):
+        batch = hashes[start:start + parse_documents.WRITE_BATCH_SIZE]
+        rows = conn.execute(
+            f"SELECT content_hash, vector FROM embeddings WHERE model = ? "
+            f"AND content_hash IN ({', '.join('?' for _ in batch)})",
+            [model, *batch]
+        )
+        for key, blob in rows:
+            vectors[key] = array("f", blob)
+    return vectors
+
+
+def embed_missing(conn, embedding_model, texts_by_hash, vectors, model=EMBEDDING_MODEL):
+    """Кодирует тексты, которых нет в кэше, пачками и сразу сохраняет каждую пачку"""
+    missing = [key for key in texts_by_hash if key not in vectors]
+    for start in range(0, len(missing), EMBED_BATCH_SIZE):
+        batch = missing[start:start + EMBED_BATCH_SIZE]
+        encoded = embedding_model.embed_documents([texts_by_hash[key] for key in batch])
+        rows = []
+        for key, vector in zip(batch, encoded):
+            vectors[key] = array("f", vector)
+            rows.append((key, model, len(vector), vectors[key].tobytes()))
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (content_hash, model, dim, vector) VALUES (?, ?, ?, ?)",
+                rows
+            )
+        print(f"🔄 Закодировано {min(start + EMBED_BATCH_SIZE, len(missing))}/{len(missing)}")
+    return len(missing)
+
+
+def prune_embeddings(conn, hashes, model=EMBEDDING_MODEL):
+    """Удаляет из кэша эмбеддинги чанков, которых больше нет в корпусе"""
+    with conn:
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS live_hashes (content_hash TEXT PRIMARY KEY)")
+        conn.execute("DELETE FROM live_hashes")
+        conn.executemany("INSERT OR IGNORE INTO live_hashes VALUES (?)", ((key,) for key in hashes))
+        removed = conn.execute(
+            "DELETE FROM embeddings WHERE model = ? "
+            "AND content_hash NOT IN (SELECT content_hash FROM live_hashes)",
+            (model,)
+        ).rowcount
+    return removed
+
 
 def main():
     print("📄 Парсим и фильтруем документы...")
-    chunks = parse_documents.main()
+    parse_documents.main()
+    chunks = parse_documents.load_chunks_from_db()
 
     print("🔄 Генерируем эмбеддинги...")
-    embedding_model = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
-    vectorstore = FAISS.from_documents(chunks, embedding_model)
+    embedding_model = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL)
+    hashes = [parse_documents.text_hash(chunk["chunk"]) for chunk in chunks]
+    texts_by_hash = dict(zip(hashes, (chunk["chunk"] for chunk in chunks)))
+
+    conn = parse_documents.connect_db(parse_documents.DB_PATH)
+    try:
+        init_embeddings_table(conn)
+        vectors = load_cached_vectors(conn, texts_by_hash)
+        encoded = embed_missing(conn, embedding_model, texts_by_hash, vectors)
+        removed = prune_embeddings(conn, texts_by_hash)
+        print(f"✅ Из кэша: {len(texts_by_hash) - encoded}, закодировано заново: {encoded}, удалено устаревших: {removed}")
+    finally:
+        conn.close()
+
+    vectorstore = FAISS.from_embeddings(
+        [(chunk["chunk"], list(vectors[key])) for chunk, key in zip(chunks, hashes)],
+        embedding_model,
+        metadatas=[
+            {"source": chunk["document_name"], "sources": chunk["sources"], "chunk_id": chunk["id"]}
+            for chunk in chunks
+        ]
+    )
 
     print("💾 Сохраняем векторную базу...")
-    vectorstore.save_local("faiss_index")
+    vectorstore.save_local(FAISS_INDEX_PATH)
+    ids_path = os.path.join(FAISS_INDEX_PATH, CHUNK_IDS_FILE)
+    with open(ids_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"chunk_ids": [chunk["id"] for chunk in chunks], "content_hashes": hashes}, f)
+    os.replace(ids_path + ".tmp", ids_path)
     print("✅ База обновлена!")
 
 if __name__ == "__main__":